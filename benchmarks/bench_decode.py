@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Measures the cost of receiving and decoding a large ``find`` response,
+fed to the parser in socket-sized chunks, and compares it with the former
+implementation (bytes concatenation, then split and json.loads on the
+whole message), and with the binary protocol (length-prefixed frames, with
+each available codec).
+
+Usage: python benchmarks/bench_decode.py [nb_rows]
+"""
+
+import os
+import sys
+import json
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import kb
+
+
+def make_rows(nb_rows):
+    return [{"agent": "http://www.example.org/robots#agent_%d" % i,
+             "action": "http://www.example.org/actions#action_%d" % i} for i in range(nb_rows)]
+
+def make_response(nb_rows):
+    return ("ok\n%s\n" % json.dumps(make_rows(nb_rows)) + kb.MSG_SEPARATOR).encode("utf-8")
+
+def make_frame(nb_rows, codec):
+    dumps, loads = kb._available_codecs()[codec]
+    return kb.encode_frame(dumps, ["ok", make_rows(nb_rows)])
+
+def chunks(data, size = kb.RECV_BUFFER_SIZE):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+def legacy_parse(data):
+    """ The receive path before the MessageParser (asynchat-like buffering,
+    then split & json.loads).
+    """
+    terminator = kb.MSG_SEPARATOR.encode()
+    in_buffer = b""
+    for chunk in chunks(data):
+        in_buffer = in_buffer + chunk
+    raw = in_buffer[:in_buffer.find(terminator)]
+    parts = raw.decode("utf-8").strip().split('\n')
+    return json.loads(parts[1])
+
+def parser_parse(data):
+    parser = kb.MessageParser()
+    for chunk in chunks(data):
+        for status, value in parser.feed(chunk):
+            return value
+
+def frame_parser(codec):
+    def frame_parse(data):
+        parser = kb.FrameParser(kb._available_codecs()[codec][1])
+        for chunk in chunks(data):
+            for status, value in parser.feed(chunk):
+                return value
+    return frame_parse
+
+def measure(fn, data):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(data)
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return duration, peak
+
+
+if __name__ == '__main__':
+
+    nb_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = make_response(nb_rows)
+
+    print("Decoding a %.1fMB response (%d rows):" % (len(data) / 1e6, nb_rows))
+    for name, fn in (("legacy", legacy_parse), ("MessageParser", parser_parse)):
+        duration, peak = measure(fn, data)
+        print("  %-14s %8.1f ms, peak memory %6.1f MB" % (name, duration * 1000, peak / 1e6))
+
+    for codec in kb._available_codecs():
+        frame = make_frame(nb_rows, codec)
+        duration, peak = measure(frame_parser(codec), frame)
+        print("  %-14s %8.1f ms, peak memory %6.1f MB (%.1fMB)" % ("binary/" + codec, duration * 1000, peak / 1e6, len(frame) / 1e6))
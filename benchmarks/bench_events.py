@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Measures the event-to-callback latency of the EventCallbackExecutor:
+the time between an event being queued (as the client does when it
+receives one from the server) and the execution of its callback.
+
+Usage: python benchmarks/bench_events.py [nb_events] [interval_ms]
+"""
+
+import os
+import sys
+import time
+import threading
+from queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import kb
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+def bench_events(nb_events=1000, interval=0.001):
+    events, polled = Queue(), Queue()
+    executor = kb.EventCallbackExecutor(events, polled)
+
+    latencies = []
+    done = threading.Event()
+
+    def onevent(sent):
+        latencies.append(time.perf_counter() - sent)
+        if len(latencies) == nb_events:
+            done.set()
+
+    executor.register("evt", onevent)
+    executor.start()
+
+    for i in range(nb_events):
+        events.put(("evt", time.perf_counter()))
+        time.sleep(interval)
+
+    done.wait()
+    executor.close()
+
+    return latencies
+
+
+if __name__ == '__main__':
+
+    nb_events = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    interval = float(sys.argv[2]) / 1000. if len(sys.argv) > 2 else 0.001
+
+    latencies = bench_events(nb_events, interval)
+
+    print("Event-to-callback latency over %d events (one every %.1fms):" % (nb_events, interval * 1000))
+    for p in (50, 90, 99):
+        print("  p%d: %8.1f us" % (p, percentile(latencies, p) * 1e6))
+    print("  max: %8.1f us" % (max(latencies) * 1e6))
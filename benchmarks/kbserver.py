@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" A minimal stand-in for a KB-API server (like minimalkb or ORO), to
+benchmark pykb without a real knowledge base.
+
+It speaks the same protocol as the real servers (requests and responses
+separated by ``#end#``, ``ok``/``error``/``event`` responses) and
+implements ``methods``, ``find``, ``exist``, ``lookup``, ``about``,
+``update``, ``retract``, ``subscribe`` and ``close`` on an in-memory set of
+statements, without any reasoning.
+
+The binary protocol of pykb (length-prefixed frames, encoded with msgpack,
+CBOR or JSON, and optionally compressed with zstd, lz4 or zlib) can be
+negotiated by the clients, unless ``binary`` is False.
+
+``latency`` simulates the network: each message is sent ``latency``
+seconds after it is ready, without delaying the processing of the
+following requests. ``result_size``, if set, makes ``find`` return that
+many (synthetic) results, whatever the query.
+
+Usage: python benchmarks/kbserver.py [--port 6969] [--latency 0.001] [--result-size 100000] [--text-only]
+"""
+
+import json
+import zlib
+import time
+import heapq
+import socket
+import struct
+import argparse
+import itertools
+import threading
+import socketserver
+
+SEPARATOR = b"#end#"
+
+# binary protocol: see kb.FrameParser
+FRAME_HEADER = struct.Struct("!IB")
+CODECS = {"json": (lambda value: json.dumps(value).encode("utf-8"), json.loads)}
+try:
+    import msgpack
+    CODECS["msgpack"] = (msgpack.packb, lambda data: msgpack.unpackb(data, raw = False))
+except ImportError:
+    pass
+try:
+    import cbor2
+    CODECS["cbor"] = (cbor2.dumps, cbor2.loads)
+except ImportError:
+    pass
+
+FRAME_COMPRESSED = 1
+COMPRESSION_THRESHOLD = 1024
+COMPRESSIONS = {"zlib": (lambda data: zlib.compress(data, 1), zlib.decompress)}
+try:
+    import zstandard
+    COMPRESSIONS["zstd"] = (zstandard.compress, zstandard.decompress)
+except ImportError:
+    pass
+try:
+    import lz4.frame
+    COMPRESSIONS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+
+class StandInKB(object):
+    """ The 'knowledge base': a set of ``(s, p, o)`` statements and the
+    event subscriptions.
+    """
+
+    def __init__(self, result_size = None):
+        self.result_size = result_size
+        self.stmts = set()
+        self.lock = threading.RLock()
+        # event id -> (connection, var, patterns, instances already notified)
+        self.subscriptions = {}
+        self._ids = itertools.count()
+
+    #### helpers ####
+    def _parse(self, stmt):
+        return tuple(stmt.split(None, 2))
+
+    def _match(self, patterns, binding = None):
+        binding = binding or {}
+        if not patterns:
+            yield dict(binding)
+            return
+
+        pattern = self._parse(patterns[0])
+        for stmt in list(self.stmts):
+            candidate = dict(binding)
+            for tok, value in zip(pattern, stmt):
+                if tok.startswith('?'):
+                    if candidate.setdefault(tok, value) != value:
+                        break
+                elif tok != value:
+                    break
+            else:
+                for b in self._match(patterns[1:], candidate):
+                    yield b
+
+    def _instances(self, var, patterns):
+        return set(b[var] for b in self._match(patterns) if var in b)
+
+    #### KB-API methods ####
+    def methods(self, connection):
+        return ["methods()", "find(vars, patterns, constraints, models)",
+                "exist(patterns, models)", "lookup(term, models)",
+                "about(term, models)", "update(stmts, models)",
+                "retract(stmts, models)",
+                "subscribe(type, trigger, var, patterns, models)", "close()"]
+
+    def find(self, connection, vars, patterns, constraints = None, models = None):
+        if self.result_size is not None:
+            if len(vars) == 1:
+                return ["result_%d" % i for i in range(self.result_size)]
+            return [dict((v.lstrip('?'), "%s_%d" % (v.lstrip('?'), i)) for v in vars) \
+                    for i in range(self.result_size)]
+
+        res = []
+        with self.lock:
+            for b in self._match(patterns):
+                row = b[vars[0]] if len(vars) == 1 else dict((v.lstrip('?'), b[v]) for v in vars)
+                if row not in res:
+                    res.append(row)
+        return res
+
+    def exist(self, connection, patterns, models = None):
+        with self.lock:
+            for b in self._match(patterns):
+                return True
+        return False
+
+    def lookup(self, connection, term, models = None):
+        with self.lock:
+            if any(term in stmt for stmt in self.stmts):
+                return [[term, "instance"]]
+        return []
+
+    def about(self, connection, term, models = None):
+        with self.lock:
+            return [list(stmt) for stmt in self.stmts if term in stmt]
+
+    def update(self, connection, stmts, models = None):
+        with self.lock:
+            self.stmts.update(self._parse(s) for s in stmts)
+            self._fire()
+
+    def retract(self, connection, stmts, models = None):
+        with self.lock:
+            self.stmts.difference_update(self._parse(s) for s in stmts)
+
+    def subscribe(self, connection, type, trigger, var, patterns, models = None):
+        with self.lock:
+            evtid = "evt_%d" % next(self._ids)
+            self.subscriptions[evtid] = (connection, var, patterns, self._instances(var, patterns))
+            return evtid
+
+    def _fire(self):
+        for evtid, (connection, var, patterns, known) in list(self.subscriptions.items()):
+            new = self._instances(var, patterns) - known
+            if new:
+                known |= new
+                connection.send_message("event", (evtid, sorted(new)))
+
+    def forget(self, connection):
+        with self.lock:
+            for evtid, subscription in list(self.subscriptions.items()):
+                if subscription[0] is connection:
+                    del self.subscriptions[evtid]
+
+
+class KBRequestHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        # (dumps, loads) of the codec of the binary protocol, and
+        # (compress, decompress) of its compression, once negotiated
+        self.codec = None
+        self.compression = None
+        # messages waiting for their (simulated) network latency, ordered by
+        # sending time, then by sequence number
+        self._outgoing = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._writer = threading.Thread(target = self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def send_message(self, status, value):
+        """ Sends a response or an event. The value of an error is its
+        (type, message), the value of an event its (event id, content).
+        """
+        if self.codec:
+            if status == "error":
+                value = "%s: %s" % value
+            body = self.codec[0]([status, value])
+            flags = 0
+            if self.compression and len(body) >= COMPRESSION_THRESHOLD:
+                body = self.compression[0](body)
+                flags = FRAME_COMPRESSED
+            data = FRAME_HEADER.pack(len(body), flags) + body
+        else:
+            if status == "ok":
+                parts = ["ok", json.dumps(value)]
+            elif status == "event":
+                parts = ["event", value[0], json.dumps(value[1])]
+            else:
+                parts = ["error"] + list(value)
+            data = ("\n".join(parts) + "\n").encode("utf-8") + SEPARATOR
+
+        with self._cond:
+            heapq.heappush(self._outgoing, (time.time() + self.server.latency, next(self._seq), data))
+            self._cond.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._outgoing and not self.closed:
+                    self._cond.wait()
+                if not self._outgoing:
+                    return
+                send_at, seq, data = self._outgoing[0]
+                delay = send_at - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._outgoing)
+            try:
+                self.request.sendall(data)
+            except socket.error:
+                return
+
+    def handle(self):
+        kb = self.server.kb
+        buf = bytearray()
+        scan_from = 0
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except socket.error:
+                break
+            if not data:
+                break
+
+            buf += data
+            while True:
+                if self.codec:
+                    if len(buf) < FRAME_HEADER.size:
+                        break
+                    length, flags = FRAME_HEADER.unpack_from(buf)
+                    end = FRAME_HEADER.size + length
+                    if len(buf) < end:
+                        break
+                    body = bytes(buf[FRAME_HEADER.size:end])
+                    del buf[:end]
+                    if flags & FRAME_COMPRESSED:
+                        body = self.compression[1](body)
+                    method, args, kwargs = self.codec[1](body)
+                else:
+                    idx = buf.find(SEPARATOR, scan_from)
+                    if idx < 0:
+                        scan_from = max(0, len(buf) - len(SEPARATOR) + 1)
+                        break
+                    method, args, kwargs = self.parse(bytes(buf[:idx]))
+                    del buf[:idx + len(SEPARATOR)]
+                    scan_from = 0
+
+                if not self.process(kb, method, args, kwargs):
+                    return
+
+    def parse(self, msg):
+        lines = msg.decode("utf-8").strip().split("\n")
+        args = [json.loads(l) for l in lines[1:]]
+        kwargs = {}
+        if args and isinstance(args[-1], dict) and list(args[-1].keys()) == ["kwargs"]:
+            kwargs = args.pop()["kwargs"]
+        return lines[0], args, kwargs
+
+    def process(self, kb, method, args, kwargs):
+        if method == "close":
+            return False
+
+        if method == "negotiate" and self.server.binary:
+            self.negotiate(*args, **kwargs)
+            return True
+
+        try:
+            if method.startswith('_') or method in ("forget",):
+                raise AttributeError("Unknown method %s" % method)
+            res = getattr(kb, method)(self, *args, **kwargs)
+        except Exception as e:
+            self.send_message("error", (type(e).__name__, str(e)))
+        else:
+            self.send_message("ok", res)
+        return True
+
+    def negotiate(self, options):
+        """ Switches to the binary protocol, with the first codec proposed
+        by the client that is available here.
+        """
+        if "length" in options.get("framing", []):
+            for name in options.get("codecs", []):
+                if name in CODECS:
+                    compression = ([c for c in options.get("compression", []) if c in COMPRESSIONS] + [None])[0]
+                    self.send_message("ok", {"framing": "length", "codec": name, "compression": compression})
+                    self.codec = CODECS[name]
+                    self.compression = COMPRESSIONS.get(compression)
+                    return
+        self.send_message("ok", {"framing": None})
+
+    def finish(self):
+        self.server.kb.forget(self)
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self._writer.join()
+
+
+class KBServer(socketserver.ThreadingTCPServer):
+    """ The stand-in server. ``port = 0`` picks a free port (see ``port``).
+
+    .. code:: python
+
+        server = KBServer(latency = 0.001).start()
+        kb = KB(port = server.port)
+        ...
+        server.stop()
+
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host = "localhost", port = 0, latency = 0., result_size = None, binary = True):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), KBRequestHandler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.binary = binary
+        self.kb = StandInKB(result_size)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target = self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Stand-in KB-API server, for benchmarks.")
+    parser.add_argument("--host", default = "localhost")
+    parser.add_argument("--port", type = int, default = 6969)
+    parser.add_argument("--latency", type = float, default = 0., help = "simulated network latency, in seconds")
+    parser.add_argument("--result-size", type = int, default = None, help = "number of results returned by 'find'")
+    parser.add_argument("--text-only", action = "store_true", help = "do not support the binary protocol")
+    args = parser.parse_args()
+
+    server = KBServer(args.host, args.port, args.latency, args.result_size, not args.text_only)
+    print("Stand-in knowledge base listening on %s:%d" % (args.host, server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Runs the pykb benchmark suite against the stand-in server of
+``kbserver.py`` (started in-process), and optionally saves the results as a
+baseline, or compares them with a previously saved baseline.
+
+Measured:
+
+- call latency (p50/p90/p99) of sequential ``exist`` requests,
+- throughput of sequential vs pipelined (``submit``) requests, the cost of
+  50 ``exist`` in a loop vs with ``exist_many``, and the throughput of
+  requests from concurrent threads sharing one ``KB`` vs a ``KBPool``,
+- end-to-end cost of a large ``find`` response (``kb[...]``, ``kb.iter``
+  and ``kb[...]`` building a ``ResultSet``),
+  with the text and the binary protocol (with and without compression, also
+  reporting the received kilobytes), and the decoding cost alone (see
+  ``bench_decode.py``),
+- event-to-callback latency, from the ``kb += ...`` that triggers the event
+  (and for the executor alone, see ``bench_events.py``),
+- connection startup time (``KB()`` until ready, then ``close()``), with
+  and without a cached method table, and the import time of the module
+  (in a fresh interpreter).
+
+Latencies are in microseconds, throughputs in requests/s, durations in
+milliseconds. With ``--latency``, the server delays every message by that
+many seconds, to simulate a network.
+
+Usage: python benchmarks/run.py [--quick] [--latency 0.001] [--save baseline.json] [--compare baseline.json]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import kb
+from kbserver import KBServer
+import bench_decode
+import bench_events
+
+# for each metric, whether a higher value is better
+HIGHER_IS_BETTER = ("_rps",)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+def percentiles(name, values, scale = 1e6):
+    return dict(("%s_p%d" % (name, p), percentile(values, p) * scale) for p in (50, 90, 99))
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def bench_latency(server, n):
+    with kb.KB(port = server.port) as k:
+        k += ["alfred rdf:type Human"]
+        latencies = []
+        for i in range(n):
+            start = time.perf_counter()
+            k.exist(["alfred rdf:type Human"])
+            latencies.append(time.perf_counter() - start)
+    return percentiles("call_latency_us", latencies)
+
+def bench_throughput(server, n):
+    with kb.KB(port = server.port) as k:
+        k += ["alfred rdf:type Human"]
+
+        def sequential():
+            for i in range(n):
+                k.exist(["alfred rdf:type Human"])
+
+        def pipelined():
+            futures = [k.submit("exist", ["alfred rdf:type Human"]) for i in range(n)]
+            for f in futures:
+                f.result()
+
+        patterns = ["obj_%d isIn kitchen" % i for i in range(50)]
+        return {"sequential_rps": n / timed(sequential),
+                "pipelined_rps": n / timed(pipelined),
+                "exist_50_loop_ms": timed(lambda: [p in k for p in patterns]) * 1000,
+                "exist_50_many_ms": timed(lambda: k.exist_many(patterns)) * 1000}
+
+def bench_concurrency(server, n, nb_threads = 8):
+    def run(k):
+        def worker():
+            for i in range(n // nb_threads):
+                k.exist(["alfred rdf:type Human"])
+        threads = [threading.Thread(target = worker) for i in range(nb_threads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return n / (time.perf_counter() - start)
+
+    with kb.KB(port = server.port) as k:
+        k += ["alfred rdf:type Human"]
+        shared = run(k)
+    with kb.KBPool(port = server.port, size = nb_threads) as pool:
+        pooled = run(pool)
+    return {"threads_shared_rps": shared, "threads_pool_rps": pooled}
+
+def bench_large_find(server, nb_rows):
+    server.kb.result_size = nb_rows
+    try:
+        with kb.KB(port = server.port) as k:
+            res = {"large_find_ms": timed(lambda: k["?agent desires ?action"]) * 1000,
+                   "large_iter_ms": timed(lambda: sum(1 for r in k.iter("?agent desires ?action"))) * 1000}
+        with kb.KB(port = server.port, result_sets = True) as k:
+            res["large_find_result_set_ms"] = timed(lambda: k["?agent desires ?action"]) * 1000
+        for name, options in (("binary", {"binary": True}), ("compressed", {"compression": True})):
+            with kb.KB(port = server.port, **options) as k:
+                metrics = k.enable_stats()
+                res["large_find_%s_ms" % name] = timed(lambda: k["?agent desires ?action"]) * 1000
+                res["large_find_%s_kb" % name] = metrics.bytes_received / 1e3
+    finally:
+        server.kb.result_size = None
+
+    data = bench_decode.make_response(nb_rows)
+    res["decode_ms"] = timed(lambda: bench_decode.parser_parse(data)) * 1000
+    codec = next(iter(kb._available_codecs()))
+    frame = bench_decode.make_frame(nb_rows, codec)
+    res["decode_binary_ms"] = timed(lambda: bench_decode.frame_parser(codec)(frame)) * 1000
+    return res
+
+def bench_event_latency(server, n):
+    latencies = []
+    sent = {}
+    done = threading.Event()
+
+    def onevent(instances):
+        received = time.perf_counter()
+        for instance in instances:
+            latencies.append(received - sent[instance])
+        if len(latencies) >= n:
+            done.set()
+
+    with kb.KB(port = server.port) as k:
+        k.subscribe(["?obj isIn kitchen"], onevent)
+        for i in range(n):
+            sent["obj_%d" % i] = time.perf_counter()
+            k += ["obj_%d isIn kitchen" % i]
+        done.wait(30)
+
+    res = percentiles("event_latency_us", latencies)
+    res.update(percentiles("executor_latency_us", bench_events.bench_events(n, 0.0005)))
+    return res
+
+def bench_startup(server, n):
+    res = {}
+    for name, cache_methods in (("startup_ms", False), ("startup_cached_ms", True)):
+        durations = []
+        for i in range(n):
+            start = time.perf_counter()
+            k = kb.KB(port = server.port, cache_methods = cache_methods)
+            k.exist(["alfred rdf:type Human"])
+            k.close()
+            durations.append(time.perf_counter() - start)
+        res.update(percentiles(name, durations, scale = 1e3))
+
+    imports = []
+    for i in range(max(3, n // 10)):
+        # -X importtime reports the cumulated import time of each module (in us)
+        out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import kb"],
+                             cwd = os.path.dirname(os.path.abspath(kb.__file__)),
+                             stderr = subprocess.PIPE, universal_newlines = True).stderr
+        line = [l for l in out.splitlines() if l.endswith("| kb")][0]
+        imports.append(int(line.split("|")[1]) / 1e6)
+    res["import_ms"] = percentile(imports, 50) * 1e3
+    return res
+
+
+def run(latency = 0., quick = False):
+    scale = 10 if quick else 1
+    server = KBServer(latency = latency).start()
+    try:
+        results = {}
+        results.update(bench_latency(server, 2000 // scale))
+        results.update(bench_throughput(server, 10000 // scale))
+        results.update(bench_concurrency(server, 10000 // scale))
+        results.update(bench_large_find(server, 100000 // scale))
+        results.update(bench_event_latency(server, 500 // scale))
+        results.update(bench_startup(server, 100 // scale))
+        return results
+    finally:
+        server.stop()
+
+def compare(results, baseline):
+    print("%-28s %12s %12s %8s" % ("", "baseline", "current", "change"))
+    for name in sorted(results):
+        value = results[name]
+        if name not in baseline:
+            print("%-28s %12s %12.1f" % (name, "-", value))
+            continue
+        ref = baseline[name]
+        change = (value - ref) / ref * 100 if ref else 0.
+        better = (change > 0) == name.endswith(HIGHER_IS_BETTER)
+        print("%-28s %12.1f %12.1f %+7.1f%%%s" % (name, ref, value, change, "" if better or not change else " (worse)"))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "pykb benchmark suite.")
+    parser.add_argument("--latency", type = float, default = 0., help = "simulated network latency, in seconds")
+    parser.add_argument("--quick", action = "store_true", help = "10 times fewer iterations")
+    parser.add_argument("--save", metavar = "FILE", help = "save the results as a baseline")
+    parser.add_argument("--compare", metavar = "FILE", help = "compare the results with a saved baseline")
+    args = parser.parse_args()
+
+    results = run(args.latency, args.quick)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
+    else:
+        for name in sorted(results):
+            print("%-28s %12.1f" % (name, results[name]))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "codecs": list(kb._available_codecs()),
+                       "compressions": list(kb._available_compressions()),
+                       "platform": platform.platform(),
+                       "latency": args.latency,
+                       "quick": args.quick,
+                       "results": results}, f, indent = 2, sort_keys = True)
@@ -5,25 +5,34 @@ import logging
 kblogger = logging.getLogger("kb")
 DEBUG_LEVEL = logging.WARN
 
+import os
 import sys
-from errno import ECONNREFUSED, EWOULDBLOCK, EAGAIN
-import threading, asyncore
-import asynchat
+import threading
 import socket
 import time
-import random
-import shlex
+import itertools
+import bisect
 import json
-import traceback
+import re
+import codecs
+import struct
+import operator
+import contextlib
+import weakref
+from collections import deque, OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import Future
+from functools import lru_cache
+from queue import Queue
 
-try:
-    from Queue import Queue, Empty
-except ImportError: #Python3 compat
-    from queue import Queue, Empty
 
-
-EVENT_POLLING_RATE = 20 #Hz
 DEFAULT_PORT = 6969
+RECV_BUFFER_SIZE = 65536 # bytes
+# messages of the binary protocol larger than this are compressed, if a
+# compression was negotiated (see RemoteKBClient.negotiate)
+COMPRESSION_THRESHOLD = 1024 # bytes
+# number of rows decoded at once when building a ResultSet
+RESULT_SET_PAGE_SIZE = 10000
 
 class NullHandler(logging.Handler):
     """Defines a NullHandler for logging, in case kb is used in an application
@@ -43,112 +52,685 @@ class KbError(Exception):
     def __str__(self):
         return repr(self.value)
 
+class KbLoadError(KbError):
+    """ Raised by :meth:`KB.load_statements` when a chunk of statements can not be
+    loaded. ``offset`` is the number of statements of the source that were
+    successfully loaded before the failing chunk: pass it back to
+    :meth:`KB.load_statements` to resume the loading.
+    """
+    def __init__(self, value, offset):
+        KbError.__init__(self, value)
+        self.offset = offset
+
 
 class EventCallbackExecutor(threading.Thread):
+    """ Dispatches the incoming events to the callbacks registered for them.
+
+    Events without callback, and the events of the polled subscriptions
+    (see :meth:`poll`), are forwarded to the queue of polled events. The
+    thread blocks on the incoming event queue, so that events are
+    dispatched as soon as they arrive.
 
-    def __init__(self, in_event_queue, out_polled_event_queue, callback_queue):
+    Callbacks are executed by a pool of ``workers`` threads. The events of
+    a given event id are always handled one after the other, in order, while
+    the callbacks of different events run in parallel.
+    """
+
+    def __init__(self, in_event_queue, out_polled_event_queue, workers = 1):
         threading.Thread.__init__(self)
 
-        self.running = True
         self._events = in_event_queue
         self._polled_events = out_polled_event_queue
-        self._callbacks_queue = callback_queue
         self._callbacks = {}
+        # event id -> number of polled subscriptions
+        self._polled = {}
+        self._lock = threading.Lock()
+
+        # values waiting for their callbacks, per event id. An event id is
+        # 'scheduled' when it is in the ready queue or handled by a worker:
+        # only one worker at a time handles a given event id.
+        self._pending = {}
+        self._scheduled = set()
+        self._ready = Queue()
+        self._stats = {}
+
+        self._workers = [threading.Thread(target=self._work, name="kb-callbacks-%d" % i) \
+                         for i in range(max(1, workers))]
+
+    def register(self, eventid, callback):
+        """ Registers a callback for the given event. Applies to the very next
+        event dispatched.
+        """
+        with self._lock:
+            self._callbacks.setdefault(eventid,[]).append(callback)
+            self._pending.setdefault(eventid, deque())
+            self._stats.setdefault(eventid, {"queued": 0,
+                                             "processed": 0,
+                                             "callback_time": 0.,
+                                             "max_callback_time": 0.})
+
+    def unregister(self, eventid, callback):
+        """ Removes one registration of a callback. The events of an event
+        id left without callbacks are dropped.
+        """
+        with self._lock:
+            self._callbacks[eventid].remove(callback)
 
-    def run(self):
+    def poll(self, eventid):
+        """ Counts one more polled subscription to the given event: its
+        events are put (once, whatever the count) in the queue of polled
+        events, from the dispatching thread.
+        """
+        with self._lock:
+            self._polled[eventid] = self._polled.get(eventid, 0) + 1
 
-        while self.running:
-            # wait for an event. Can not be blocking else we can not join the thread.
-            eventid, value = None, None
-            try:
-                eventid, value = self._events.get_nowait()
-            except Empty:
-                time.sleep(1. / EVENT_POLLING_RATE)
-                continue
+    def unpoll(self, eventid):
+        """ Removes one polled subscription. The events of an event id left
+        without polled subscriptions and callbacks are dropped.
+        """
+        with self._lock:
+            if not self._polled.get(eventid):
+                raise ValueError(eventid)
+            self._polled[eventid] -= 1
+
+    def stats(self):
+        """ Returns, for each event id with callbacks, the number of events
+        waiting for their callbacks ('queued'), the number of events already
+        processed, and the total and maximum time spent in the callbacks (in
+        seconds).
+        """
+        with self._lock:
+            stats = {}
+            for eventid, s in self._stats.items():
+                stats[eventid] = dict(s, queued = len(self._pending[eventid]))
+            return stats
 
-            # check if new callbacks have been registered
-            try:
-                while True:
-                    newid, cb = self._callbacks_queue.get_nowait()
-                    self._callbacks.setdefault(newid,[]).append(cb)
-            except Empty:
-                pass
+    def run(self):
 
-            if eventid not in self._callbacks:
-                # no callback associated. Put it back to the event queue for manual
-                # polling by the user
-                self._polled_events.put((eventid, value))
+        for worker in self._workers:
+            worker.start()
+
+        while True:
+            event = self._events.get()
+            if event is _CLOSED:
+                for worker in self._workers:
+                    self._ready.put(_CLOSED)
+                for worker in self._workers:
+                    worker.join()
                 self._events.task_done()
-            else:
-                for cb in self._callbacks[eventid]:
-                    kblogger.debug("Executing callback %s" % cb.__name__)
-                    cb(value)
+                break
+
+            eventid, value = event
+            with self._lock:
+                if self._polled.get(eventid) or \
+                   (eventid not in self._callbacks and eventid not in self._polled):
+                    # polled subscription, or no callback associated. Put it
+                    # back to the event queue for manual polling by the user
+                    self._polled_events.put((eventid, value))
+                if not self._callbacks.get(eventid):
                     self._events.task_done()
+                    continue
+
+                self._pending[eventid].append(value)
+                if eventid in self._scheduled:
+                    continue
+                self._scheduled.add(eventid)
+
+            self._ready.put(eventid)
+
+    def _work(self):
+
+        while True:
+            eventid = self._ready.get()
+            if eventid is _CLOSED:
+                break
+
+            with self._lock:
+                value = self._pending[eventid].popleft()
+                callbacks = list(self._callbacks[eventid])
+
+            start = time.time()
+            for cb in callbacks:
+                kblogger.debug("Executing callback %s" % cb.__name__)
+                try:
+                    cb(value)
+                except Exception as e:
+                    kblogger.error("Exception in the callback %s: %s" % (cb.__name__, e))
+            duration = time.time() - start
+
+            with self._lock:
+                stats = self._stats[eventid]
+                stats["processed"] += 1
+                stats["callback_time"] += duration
+                stats["max_callback_time"] = max(stats["max_callback_time"], duration)
+
+                # more events for this event id? go back to the end of the
+                # ready queue, to be fair with the other events.
+                reschedule = bool(self._pending[eventid])
+                if not reschedule:
+                    self._scheduled.discard(eventid)
+
+            self._events.task_done()
+            if reschedule:
+                self._ready.put(eventid)
 
     def close(self):
         # make sure all received events are handled
         self._events.join()
-        self.running = False
+        self._events.put(_CLOSED)
         self.join()
 
 
+_CLOSED = object() # marks the end of an event stream
+
 MSG_SEPARATOR = "#end#"
 
 KB_OK="ok"
 KB_ERROR="error"
 KB_EVENT="event"
 
+# read-only methods whose results can be cached (see KB.enable_cache), and
+# methods that modify the knowledge base (and invalidate the cache)
+CACHED_METHODS = ("find", "lookup", "exist")
+WRITE_METHODS = ("add", "update", "retract", "revise", "clear", "load", "reset")
+
+
+class QueryCache(object):
+    """ A thread-safe LRU cache of query results, with an optional
+    time-to-live (in seconds). See :meth:`KB.enable_cache`.
+    """
+
+    def __init__(self, size = 1024, ttl = None):
+        self.size = size
+        self.ttl = ttl
+
+        self._entries = OrderedDict() # key -> (timestamp, value)
+        self._lock = threading.Lock()
+        # incremented by each invalidation, so that the result of a query
+        # started before an invalidation is not stored after it
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def fetch(self, key, compute):
+        """ Returns the cached value for ``key``, or calls ``compute()``
+        and caches its result.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and (self.ttl is None or time.time() - entry[0] < self.ttl):
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return _copy(entry[1])
+            self.misses += 1
+            generation = self._generation
+
+        value = compute()
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (time.time(), value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last = False)
+
+        return _copy(value)
+
+    def invalidate(self, *args):
+        """ Empties the cache. Accepts (and ignores) any argument, so that
+        it can be used as an event callback.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "entries": len(self._entries),
+                    "invalidations": self.invalidations}
+
+def _copy(value):
+    # callers are free to modify the lists they get, and their rows
+    if isinstance(value, list):
+        return [row.copy() if isinstance(row, (dict, list)) else row for row in value]
+    return value
+
+
+class Histogram(object):
+    """ A histogram of durations (in seconds), with logarithmic buckets from
+    1µs (four buckets per doubling). Percentiles are estimated with the upper
+    bound of their bucket, so within ~20%.
+    """
+
+    BUCKETS = [1e-6 * 2 ** (i / 4.) for i in range(105)] # up to ~80s
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, duration):
+        self.counts[bisect.bisect_left(self.BUCKETS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.
+        rank = self.count * p / 100.
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else 0.,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+
+class Metrics(object):
+    """ Per-method metrics of the requests sent to a remote knowledge base:
+    see :meth:`KB.enable_stats`.
+
+    For each request, the client records the time spent encoding it,
+    sending it (writing it to the socket), waiting for the response (from
+    the end of the sending until the response is fully received: the
+    server and the network) and decoding the response, as well as the
+    total latency.
+
+    If the messages are compressed, it also records how many were
+    compressed and decompressed, the bytes this saved and the time it took.
+    """
+
+    PHASES = ("encode", "send", "wait", "decode", "total")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+        self.started = time.time()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.events = 0
+        # compression of the messages (see KB(compression = True)): number
+        # of messages, bytes before - after, and time spent
+        self._compression = {"compressed": 0, "compressed_bytes_saved": 0, "compress_time": 0.,
+                             "decompressed": 0, "decompressed_bytes_saved": 0, "decompress_time": 0.}
+
+    def _method(self, method):
+        stats = self._methods.get(method)
+        if stats is None:
+            stats = {"calls": 0, "errors": 0, "bytes_sent": 0, "bytes_received": 0}
+            stats.update((phase, Histogram()) for phase in self.PHASES)
+            self._methods[method] = stats
+        return stats
+
+    def request(self, method, encode, send, size):
+        with self._lock:
+            stats = self._method(method)
+            stats["calls"] += 1
+            stats["bytes_sent"] += size
+            stats["encode"].record(encode)
+            stats["send"].record(send)
+            self.bytes_sent += size
+
+    def response(self, method, wait, decode, total, size, error):
+        with self._lock:
+            stats = self._method(method)
+            stats["bytes_received"] += size
+            if error:
+                stats["errors"] += 1
+            stats["wait"].record(wait)
+            stats["decode"].record(decode)
+            stats["total"].record(total)
+
+    def received(self, size):
+        with self._lock:
+            self.bytes_received += size
+
+    def event(self):
+        with self._lock:
+            self.events += 1
+
+    def compressed(self, size, compressed_size, duration):
+        with self._lock:
+            self._compression["compressed"] += 1
+            self._compression["compressed_bytes_saved"] += size - compressed_size
+            self._compression["compress_time"] += duration
+
+    def decompressed(self, size, compressed_size, duration):
+        with self._lock:
+            self._compression["decompressed"] += 1
+            self._compression["decompressed_bytes_saved"] += size - compressed_size
+            self._compression["decompress_time"] += duration
+
+    def snapshot(self):
+        with self._lock:
+            methods = {}
+            for method, stats in self._methods.items():
+                methods[method] = dict((k, v.snapshot() if isinstance(v, Histogram) else v) \
+                                       for k, v in stats.items())
+            return {"since": self.started,
+                    "bytes_sent": self.bytes_sent,
+                    "bytes_received": self.bytes_received,
+                    "events": self.events,
+                    "compression": dict(self._compression),
+                    "methods": methods}
+
+
+# method tables of the knowledge bases, per (host, port). See KB(cache_methods = True)
+_method_tables = {}
+
+# server methods whose proxies have a different name, not to hide the KB methods
+_PROXY_NAMES = {"subscribe": "server_subscribe",
+                "close": "server_close"}
+
+# same for AsyncKB, whose add and remove coroutines wrap update and retract
+_ASYNC_PROXY_NAMES = dict(_PROXY_NAMES, add = "server_add", remove = "server_remove")
+
+def _proxies(methods):
+    """ Returns the proxy name -> server method mapping of a method table
+    (as returned by the ``methods`` request).
+    """
+    return dict((_PROXY_NAMES.get(m, m), m) for m in (str(m).split("(")[0] for m in methods))
+
 class KB:
+    """ Connection to a knowledge base (a remote one, or an embedded
+    MinimalKB if ``embedded`` is True).
+
+    The methods of the knowledge base are available as methods of the KB
+    (like ``kb.find(...)`` or ``kb.about(...)``): the table of methods is
+    retrieved from the server when connecting, and each proxy is created on
+    first use. With ``cache_methods = True``, the table retrieved by a
+    previous KB for the same host and port is reused, saving a round trip
+    when connecting (the table is still checked in the background).
+
+    Event callbacks are executed by a pool of ``callback_workers`` threads,
+    started with the first subscription.
+
+    With ``direct = True``, the requests to an embedded
+    knowledge base are executed directly by the calling thread (see
+    :class:`EmbeddedKBClient`).
+
+    With ``binary = True``, the client negotiates a binary protocol with the
+    server (length-prefixed messages, encoded with msgpack or CBOR if
+    installed, JSON otherwise), and falls back to the text protocol if the
+    server does not support it (see :meth:`RemoteKBClient.negotiate`).
+    ``compression = True`` implies ``binary``, and also negotiates the
+    compression of the large messages (with zstd or lz4 if installed, zlib
+    otherwise).
+
+    With ``result_sets = True``, ``find`` queries (including ``kb[...]``
+    with patterns) return a compact :class:`ResultSet` instead of a list.
+    It reads like the list, but is not one: it can not be modified (no
+    ``sort()``, ``append()``...), ``isinstance(res, list)`` is False, and
+    ``json`` (like other serializers) only accepts ``list(res)``.
+    """
 
-    def __init__(self, host='localhost', port=DEFAULT_PORT, embedded = False, defaultontology = None, sock=None):
+    def __init__(self, host='localhost', port=DEFAULT_PORT, embedded = False, defaultontology = None, sock=None, callback_workers = 1, cache_methods = False, direct = False, binary = False, compression = False, result_sets = False):
  
         #incoming events
         self._internal_events = Queue()
         # events that are not dealt with a callback
         self.events = Queue()
         self._callbackexecutor = None
+        self._executor_lock = threading.Lock()
+        self._client = None
+        self._closed = False
+        # proxy name -> server method. The proxies are created on first use
+        # (see __getattr__)
+        self._methods = {}
+        self.cache = None
+        # per-thread stack of the active batches (see KB.batch)
+        self._local = threading.local()
+        self._write_behind = None
+        # normalized subscription -> [event id, number of subscribers] (see
+        # KB.subscribe)
+        self._subscriptions = {}
+        self._subscriptions_lock = threading.Lock()
+        self.metrics = None
+        self._stop_reporting = None
+        self.result_sets = result_sets
 
         self.embedded = embedded
         if not self.embedded:
             if not host or not port:
                 raise KbError("No host and/or port specified to connect to the knowledge base.")
-            self._channels = {}
-            self._asyncore_thread = threading.Thread( target = asyncore.loop, kwargs = {'timeout': .1, 'map': self._channels} )
-            self._client = RemoteKBClient(self._internal_events, self._channels, host, port, sock)
-            self._asyncore_thread.start()
+            self._client = self._connect(host, port, sock, binary, compression)
         else:
-            self._client = EmbeddedKBClient(defaultontology)
+            self._client = EmbeddedKBClient(self._internal_events, defaultontology, direct)
+
+        #add to the KB class all the methods the server declares. With
+        # 'cache_methods', the method table of a previous connection to the
+        # same server is used right away, and checked in the background.
+        self._methods_key = None if embedded else (host, port)
+        methods = _method_tables.get(self._methods_key) if cache_methods else None
+        if methods:
+            self._set_methods(methods)
+            self._client.call_server_async("methods").add_done_callback(self._check_methods)
+        else:
+            methods = self._client.call_server("methods")
+            if not methods:
+                raise KbError("Could not connect to the knowledge base. Is it started?")
+            self._set_methods(methods)
+            if cache_methods:
+                _method_tables[self._methods_key] = methods
 
-        #add to the KB class all the methods the server declares
-        methods = self._client.call_server("methods")
-        if not methods:
-            raise KbError("Could not connect to the knowledge base. Is it started?")
-        for m in methods:
-            self.add_method(m.split("(")[0])
+        #new subscribers. The callbackExecutor thread is only started with
+        # the first subscription (events do not come before)
+        self._callbackexecutor = EventCallbackExecutor(self._internal_events, self.events, callback_workers)
+
+    def _connect(self, host, port, sock, binary, compression):
+        return RemoteKBClient(self._internal_events, host, port, sock, binary, compression)
+
+    def _set_methods(self, methods):
+        self._methods = _proxies(methods)
+
+    def _check_methods(self, future):
+        # called when the actual method table of the server is received
+        try:
+            methods = future.result()
+        except KbError as e:
+            kblogger.error("Could not retrieve the methods of the knowledge base: %s" % e)
+            return
+
+        if methods == _method_tables.get(self._methods_key):
+            return
+
+        kblogger.info("The methods of the knowledge base on %s:%s have changed." % self._methods_key)
+        _method_tables[self._methods_key] = methods
+        previous = self._methods
+        self._set_methods(methods)
+        for name in set(previous) - set(self._methods):
+            self.__dict__.pop(name, None)
+
+    def __getattr__(self, name):
+        # only called for missing attributes: creates the proxies of the
+        # server's methods on first use
+        method = self.__dict__.get("_methods", {}).get(name)
+        if method is None:
+            raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+        return self.add_method(method)
 
-        #new subscribers. The callbackExecutor thread is started only at the
-        # end of the constructor -> we first want to be sure we were able
-        # to connect to the knowledge base
-        self._registered_callbacks = Queue()
-        self._callbackexecutor = EventCallbackExecutor(self._internal_events, self.events, self._registered_callbacks)
-        self._callbackexecutor.start()
+    def _start_callbacks(self):
+        with self._executor_lock:
+            if not self._callbackexecutor.is_alive() and not self._closed:
+                self._callbackexecutor.start()
 
 
     def add_method(self, m):
         m = str(m) # convert from unicode...
         def innermethod(*args, **kwargs):
-            kblogger.debug("Sending <%s(%s,%s)> request to server." % \
-                            (m, 
-                             ", ".join([str(a) for a in args]),
-                             ", ".join(str(k)+"="+str(v) for k,v in kwargs.items())))
-            return self._client.call_server(m, *args, **kwargs)
+            return self._call(m, args, kwargs)
                 
         innermethod.__doc__ = "This method is a proxy for the knowledge server %s method." % m
         #special cases for the server's methods we want to override
-        if m == "subscribe": innermethod.__name__ = "server_subscribe"
-        elif m == "close": innermethod.__name__ = "server_close"
-        else: innermethod.__name__ = m
+        innermethod.__name__ = _PROXY_NAMES.get(m, m)
         setattr(self,innermethod.__name__,innermethod)
+        return innermethod
+
+    def submit(self, method, *args, **kwargs):
+        """ Sends a request to the knowledge base without waiting for the
+        answer, and returns a :class:`concurrent.futures.Future` that will hold
+        the server's response (or raise a :class:`KbError`).
+
+        Requests are pipelined on the connection: many requests can be in
+        flight at the same time, and each response is delivered to the future
+        of the request it answers, even if the KB is shared between threads.
+
+        .. code:: python
+
+            futures = [kb.submit("exist", ["%s rdf:type Cup" % o]) for o in objects]
+            cups = [o for o, f in zip(objects, futures) if f.result()]
+
+        """
+        if method == "subscribe":
+            self._start_callbacks()
+
+        cache = self.cache
+        if cache is None or method not in WRITE_METHODS:
+            return self._client.call_server_async(method, *args, **kwargs)
+
+        cache.invalidate()
+        future = self._client.call_server_async(method, *args, **kwargs)
+        future.add_done_callback(cache.invalidate)
+        return future
+
+    def find_many(self, queries, models = None):
+        """ Runs many independent queries at once, and returns their
+        results in the same order. Each query is what :meth:`__getitem__`
+        accepts: a pattern, or a list of patterns.
+
+        The queries are pipelined on the connection (see :meth:`submit`):
+        they cost about one round trip in total, instead of one each. A
+        query that fails does not fail the others: its :class:`KbError`
+        is returned in place of its result.
+
+        .. code:: python
+
+            rooms = kb.find_many(["%s isIn ?room" % obj for obj in objects])
+
+        """
+        requests = []
+        for query in queries:
+            args = tuple(_as_list(query)) + ((models,) if models else ())
+            method, query, row = _getitem_request(args)
+            if method == "find" and self.result_sets:
+                convert = lambda res, vars = query[0]: ResultSet(vars, res)
+            else:
+                convert = (lambda res, row = row: [row(r) for r in res]) if row else None
+            requests.append((self.submit(method, *query), convert))
+        return _gather(requests)
+
+    def exist_many(self, patterns, models = None):
+        """ Same as :meth:`find_many`, for ``in`` tests: each item is what
+        :meth:`__contains__` accepts (a term or a pattern), or a list of
+        patterns, and the result tells whether it is in the knowledge base:
+        ``kb.exist_many(items) == [item in kb for item in items]``.
+        """
+        options = (models,) if models else ()
+        requests = []
+        for item in patterns:
+            if isinstance(item, str):
+                method, args = _contains_request(item)
+            else:
+                method, args = "exist", (list(_expand(tuple(_tokenize(p) for p in item))[0]),)
+            requests.append((self.submit(method, *(args + options)), bool))
+        return _gather(requests)
+
+    def lookup_many(self, terms, models = None):
+        """ Same as :meth:`find_many`, for ``lookup`` requests: returns
+        the response of the knowledge base for each term.
+        """
+        options = (models,) if models else ()
+        return _gather([(self.submit("lookup", term, *options), None) for term in terms])
+
+    def _call(self, method, args, kwargs, key = None):
+        """ Sends a request to the server and waits for the response, going
+        through the cache if enabled. ``key`` is the cache key of the
+        request, if it is not simply made of the method and its arguments.
+        """
+        _debug_request(method, args, kwargs)
+
+        if method == "subscribe":
+            self._start_callbacks()
+
+        cache = self.cache
+        if method == "find" and self.result_sets:
+            fetch = lambda: self._result_set(args, kwargs)
+            if cache is None:
+                return fetch()
+            if key is None:
+                key = (method, json.dumps([args, kwargs], sort_keys = True))
+            return cache.fetch(("ResultSet", key), fetch)
+
+        if cache is None:
+            return self._client.call_server(method, *args, **kwargs)
+
+        if method in WRITE_METHODS:
+            cache.invalidate()
+            try:
+                return self._client.call_server(method, *args, **kwargs)
+            finally:
+                cache.invalidate()
+
+        if method not in CACHED_METHODS:
+            return self._client.call_server(method, *args, **kwargs)
+
+        if key is None:
+            key = (method, json.dumps([args, kwargs], sort_keys = True))
+        return cache.fetch(key, lambda: self._client.call_server(method, *args, **kwargs))
+
+    def _result_set(self, args, kwargs):
+        vars = kwargs["vars"] if "vars" in kwargs else args[0]
+        if not hasattr(self._client, "call_server_stream"):
+            return ResultSet(vars, self._client.call_server("find", *args, **kwargs))
+
+        # the rows are converted while they are received, without ever
+        # holding the whole decoded response
+        stream = ResultStream(RESULT_SET_PAGE_SIZE)
+        return ResultSet(vars, self._client.call_server_stream(stream, "find", *args, **kwargs))
+
+    def enable_cache(self, size = 1024, ttl = None, watch = None):
+        """ Enables a client-side LRU cache for the read-only queries
+        (``find``, ``lookup`` and ``exist``, and thus ``kb[...]`` and
+        ``... in kb``), holding up to ``size`` results for at most ``ttl``
+        seconds (forever if None).
+
+        The cache is emptied each time the knowledge base is modified through
+        this KB (``+=``, ``-=``, ``update``, ``retract``...). Changes made by
+        other clients can only be noticed through events: each pattern of
+        the ``watch`` list is subscribed to, and empties the cache when it
+        gets new matches. Other changes are only accounted for once the
+        cached results expire.
+
+        .. code:: python
+
+            kb.enable_cache(size = 512, ttl = 0.5, watch = ["?obj isIn ?loc"])
+            if "cup1 isIn kitchen" in kb:
+                #...
+            print(kb.cache.stats()) # hits, misses, entries, invalidations
+
+        Returns the :class:`QueryCache`.
+        """
+        self.cache = QueryCache(size, ttl)
+        for pattern in (watch or []):
+            vars = [t for t in _tokenize(pattern) if t.startswith('?')]
+            self.subscribe(pattern, self.cache.invalidate, var = vars[0] if vars else None)
+        return self.cache
 
     #### with statement ####
     def __enter__(self):
@@ -161,19 +743,33 @@ class KB:
         self.close()
 
     def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        if self._stop_reporting:
+            self._stop_reporting.set()
+
+        if self._write_behind:
+            try:
+                self._write_behind.close()
+            except KbError as e:
+                kblogger.error("Some statements could not be written: %s" % e)
+
         if self._callbackexecutor:
-            self._callbackexecutor.close()
+            with self._executor_lock:
+                started = self._callbackexecutor.is_alive()
+            if started:
+                self._callbackexecutor.close()
 
         try:
-            self.server_close() # call the KB close() method. This will also close the RemoteKBClient channel if needed
+            self.server_close() # call the KB close() method.
         except AttributeError:
             # the connection is likely not yet established, so we did not create 
             # proxies for remote methods.
             pass
 
-        if not self.embedded:
-            self._asyncore_thread.join()
-        else:
+        if self._client:
             self._client.close()
 
     def subscribe(self, pattern, callback = None, var = None, type = 'NEW_INSTANCE', trigger = 'ON_TRUE', models = None):
@@ -199,6 +795,9 @@ class KB:
 
         If 'callback' is provided, the callback will be invoked with the result of 
         the event (content depend on event type) *in a separate thread*.
+        Callbacks are executed by a pool of ``callback_workers`` threads (see
+        :class:`KB`): the events of one subscription are processed in order,
+        while a slow callback does not delay the other subscriptions.
         If not callback is provided, the incoming events are stored in the 
         KB.events queue, and you can poll them yourself (which allow for better 
         control of the execution flow).
@@ -209,32 +808,261 @@ class KB:
         The 'models' parameter allows for registering an event in a specific list 
         of models. By default, the pattern is monitored on every models.
 
-        Returns the event id of the newly created event.
+        Identical subscriptions (same patterns, in any order, variable, type,
+        trigger and models) share a single event on the server: each of its
+        events is delivered to all their callbacks, and put once in
+        ``KB.events`` if some of them have no callback. One-shot
+        subscriptions (``*_ONE_SHOT`` triggers) are not shared, as the
+        server drops their event once it fires.
+
+        Returns the event id of the event, to be passed to
+        :meth:`unsubscribe`.
         """
         
-        if isinstance(pattern, basestring):
+        pattern, var = _subscription(pattern, var, type)
+        key = (tuple(sorted(" ".join(_tokenize(p)) for p in pattern)), var, type, trigger,
+               tuple(sorted(models)) if models else None)
+        if trigger.endswith("_ONE_SHOT"):
+            # each one-shot subscription gets its own server event
+            key += (object(),)
+
+        with self._subscriptions_lock:
+            subscription = self._subscriptions.get(key)
+            if subscription is None:
+                event_id = self.server_subscribe(type, trigger, var, pattern, models)
+                kblogger.debug("New event successfully registered with ID " + event_id)
+                subscription = self._subscriptions[key] = [event_id, 0]
+            event_id = subscription[0]
+            subscription[1] += 1
+            if callback:
+                self._callbackexecutor.register(event_id, callback)
+            else:
+                self._callbackexecutor.poll(event_id)
+
+        return event_id
+
+    def unsubscribe(self, event_id, callback = None):
+        """ Cancels a subscription, given the event id returned by
+        :meth:`subscribe` and the same callback (None for a polled
+        subscription).
+
+        The server event is only removed when its last subscription is
+        cancelled, if the server has an ``unsubscribe`` method. Otherwise,
+        the event is kept (and reused by the next identical subscription),
+        and its events are dropped.
+        """
+        with self._subscriptions_lock:
+            for key, subscription in self._subscriptions.items():
+                if subscription[0] == event_id and subscription[1]:
+                    break
+            else:
+                raise KbError("No subscription to the event %s" % event_id)
+
+            try:
+                if callback:
+                    self._callbackexecutor.unregister(event_id, callback)
+                else:
+                    self._callbackexecutor.unpoll(event_id)
+            except ValueError:
+                raise KbError("The callback %s is not subscribed to the event %s" % (callback, event_id))
+
+            subscription[1] -= 1
+            if not subscription[1] and "unsubscribe" in self._methods:
+                self._call("unsubscribe", (event_id,), {})
+                del self._subscriptions[key]
+
+    def iter(self, pattern, models = None, page_size = 1000):
+        """ Lazily iterates over the results of a query.
+
+        ``pattern`` is either a single pattern or a list of patterns, with the
+        same semantics as :meth:`__getitem__`. The response is decoded while it
+        is received, and the results are handed over by pages of
+        ``page_size`` elements: the first results are available before the
+        whole response is received, and only a few pages are buffered if the
+        consumer is slower than the network.
+
+        .. code:: python
+
+            for agent in kb.iter("* rdf:type Agent", page_size = 500):
+                #...
+
+        The returned iterator can be closed (or simply dropped, like when
+        breaking out of the loop) to give up on the remaining results.
+
+        Requests sent while iterating (from any thread) are answered only
+        once the whole response has been received: in that case, the rest
+        of the response is buffered regardless of ``page_size``.
+        """
+        if isinstance(pattern, str):
             pattern = [pattern]
-        
-        if var and not var.startswith('?'):
-            var = '?' + var
-
-        if type == 'NEW_INSTANCE' and not var:
-            #Look if there's more than one variable in the pattern
-            vars = set()
-            for ps in pattern:
-                vars |= set([s for s in shlex.split(ps) if s[0] == '?'])
-            if len(vars) > 1:
-                raise AttributeError("You must specify which variable must be returned " + \
-                "when the event is triggered by setting the 'var' parameter")
+        args = tuple(pattern) + ((models,) if models else ())
+        method, args, row = _getitem_request(args)
+
+        if not hasattr(self._client, "call_server_stream"):
+            # embedded knowledge base: nothing to stream
+            res = self._call(method, args, {})
+            return iter([row(r) for r in res] if row else res)
+
+        _debug_request(method, args, {})
+        stream = ResultStream(page_size, row = row)
+        results = _consume(self._client.call_server_stream(stream, method, *args))
+        # a throttled stream would otherwise block the reception of the
+        # other responses, and of the events, once dropped by its consumer
+        weakref.finalize(results, stream.close)
+        return results
+
+    def mirror(self, patterns, models = None, refresh_interval = 10.):
+        """ Returns a :class:`KBMirror`: a local, indexed copy of the
+        statements matching ``patterns`` (a list of ``s p o`` patterns),
+        that answers the queries covered by these patterns (``mirror[...]``
+        and ``... in mirror``) without going through the network, and
+        forwards the other ones to the knowledge base.
+
+        .. code:: python
+
+            local = kb.mirror(["* rdf:type *", "?obj isIn ?place"])
+            if "cup1 isIn kitchen" in local: # answered locally
+                #...
+            print(local.stats()) # statements, memory, staleness...
+
+        The statements are loaded once, then kept up to date by events
+        (subscribed to by the mirror) for the new statements, and by a
+        full refresh every ``refresh_interval`` seconds for the others (see
+        :meth:`KBMirror.staleness`).
+        """
+        return KBMirror(self, patterns, models, refresh_interval)
+
+    def to_arrays(self, pattern, models = None, page_size = 100000):
+        """ Exports the statements matching a single ``s p o`` pattern as
+        NumPy arrays of term ids, for graph analytics (requires NumPy:
+        ``pip install pykb[numpy]``).
+
+        The results are streamed (see :meth:`iter`) and converted by pages
+        of ``page_size`` statements, so that only the arrays and the terms
+        are kept in memory.
+
+        .. code:: python
+
+            graph = kb.to_arrays("* * *")
+            print(len(graph), "statements on", len(graph.terms), "terms")
+            knows = graph.adjacency("knows") # scipy.sparse matrix
+
+        Returns a :class:`StatementArrays`.
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("KB.to_arrays requires NumPy (pip install pykb[numpy])")
+
+        toks = _tokenize(pattern)
+        if len(toks) != 3:
+            raise KbError("to_arrays expects a single 's p o' pattern, got '%s'" % pattern)
+        patterns, vars = _expand((toks,))
+        if not vars:
+            raise KbError("The pattern '%s' has no variable" % pattern)
+
+        ids = _TermIds()
+        toks = _tokenize(patterns[0])
+        chunks = ([], [], [])
+        rows = self.iter(pattern, models, page_size)
+        while True:
+            page = list(itertools.islice(rows, page_size))
+            if not page:
+                break
             if len(vars) == 1:
-                var = vars.pop()
+                columns = {vars[0]: page}
+            else:
+                columns = dict((v, list(map(operator.itemgetter(v.lstrip('?')), page))) for v in vars)
 
-        event_id = self.server_subscribe(type, trigger, var, pattern, models)
-        kblogger.debug("New event successfully registered with ID " + event_id)
-        if callback:
-            self._registered_callbacks.put((event_id, callback))
+            for chunk, tok in zip(chunks, toks):
+                if tok in columns:
+                    chunk.append(numpy.fromiter(map(ids.__getitem__, columns[tok]), numpy.int64, len(page)))
+                else:
+                    chunk.append(numpy.full(len(page), ids[tok], numpy.int64))
 
-        return event_id
+        arrays = [numpy.concatenate(c) if c else numpy.empty(0, numpy.int64) for c in chunks]
+        return StatementArrays(ids, *arrays)
+
+    def subscription_stats(self):
+        """ Returns, for each event id with callbacks, the number of events
+        waiting for their callbacks and the time spent in the callbacks. See
+        :meth:`EventCallbackExecutor.stats`.
+        """
+        return self._callbackexecutor.stats()
+
+    def enable_stats(self, hook = None, interval = 1.):
+        """ Enables the recording of per-method metrics for the requests sent
+        to the knowledge base: number of calls and errors, bytes sent and
+        received, and histograms of the time spent encoding the request,
+        sending it, waiting for the response and decoding it (see
+        :class:`Metrics`). These metrics are not recorded by default.
+
+        If ``hook`` is given, it is called with a snapshot of :meth:`stats`
+        every ``interval`` seconds (from a background thread), until the KB
+        is closed or :meth:`enable_stats` is called again.
+
+        .. code:: python
+
+            kb.enable_stats(hook = lambda s: log.info(s["methods"]["find"]["wait"]), interval = 10)
+            #...
+            stats = kb.stats()
+            print(stats["methods"]["find"]["total"]["p99"]) # in seconds
+            print(stats["queues"]) # events waiting for the executor, the user, the callbacks
+
+        Only requests to remote knowledge bases are measured. Returns the
+        :class:`Metrics`.
+        """
+        self.metrics = Metrics()
+        self._client.metrics = self.metrics
+
+        if self._stop_reporting:
+            # replaces the hook of a previous call
+            self._stop_reporting.set()
+            self._stop_reporting = None
+
+        if hook:
+            self._stop_reporting = threading.Event()
+            reporter = threading.Thread(target = self._report_stats,
+                                        args = (hook, interval, self._stop_reporting),
+                                        name = "kb-stats")
+            reporter.daemon = True
+            reporter.start()
+
+        return self.metrics
+
+    def _report_stats(self, hook, interval, stop):
+        while not stop.wait(interval):
+            try:
+                hook(self.stats())
+            except Exception as e:
+                kblogger.error("Exception in the stats hook %s: %s" % (hook.__name__, e))
+
+    def stats(self):
+        """ Returns a snapshot of the metrics recorded since
+        :meth:`enable_stats` (empty if not enabled), with the current depth
+        of the event queues ('internal_events': events received but not yet
+        dispatched, 'events': events waiting to be polled, 'callbacks':
+        events waiting for their callbacks), the number of requests waiting
+        for their response, the negotiated codec and compression algorithm
+        (None without the binary protocol), and the callbacks and cache
+        statistics.
+        """
+        stats = self.metrics.snapshot() if self.metrics else {}
+
+        callbacks = self.subscription_stats()
+        stats["queues"] = {"internal_events": self._internal_events.qsize(),
+                           "events": self.events.qsize(),
+                           "callbacks": sum(s["queued"] for s in callbacks.values())}
+        stats["pending_requests"] = len(getattr(self._client, "_pending", ()))
+        stats["codec"] = getattr(self._client, "codec", None)
+        stats["compression_algorithm"] = getattr(self._client, "compression", None)
+        stats["callbacks"] = callbacks
+        with self._subscriptions_lock:
+            stats["subscriptions"] = {"server_events": len(self._subscriptions),
+                                      "subscribers": sum(s[1] for s in self._subscriptions.values())}
+        if self.cache:
+            stats["cache"] = self.cache.stats()
+        return stats
 
     def __getitem__(self, *args):
         """This method introduces a different way of querying the ontology server.
@@ -283,38 +1111,9 @@ class KB:
             city_id = kb["ville rose"]
 
         """
-        args = args[0]
-
-        # First, take care of models
-        models = None
-        if len(args) > 1 and isinstance(args[-1], list):
-            models = args[-1]
-            args = args[:-1]
-
-
-        def get_vars(s):
-            return [v for v in s if v.startswith('?')]
-
-        # Single argument
-        if isinstance(args, (str, unicode)) or len(args) == 1:
-            pattern = args[0] if isinstance(args, list) else args
-            toks = shlex.split(pattern)
-            if len(toks) == 3:
-                pattern = self._replacestar(toks)
-                vars = get_vars(pattern)
-                return self.find(vars, ["%s %s %s" % pattern], None, models)
-            else:
-                lookup = self.lookup(pattern, models)
-                return [concept[0] for concept in lookup]
-
-        # List of patterns
-        else:
-            patterns = [self._replacestar(shlex.split(p)) for p in args]
-            allvars = set()
-            for p in patterns:
-                allvars |= set(get_vars(p))
-
-            return self.find(list(allvars), ["%s %s %s"%p for p in patterns], None, models)
+        method, query, row = _getitem_request(args[0])
+        res = self._call(method, query, {}, ("[]", _query_key(args[0])))
+        return [row(r) for r in res] if row else res
 
     def __contains__(self, pattern):
         """ This will return 'True' is either a concept - described by its ID or
@@ -331,12 +1130,8 @@ class KB:
                 #...
 
         """
-        toks = shlex.split(pattern)
-        if len(toks) == 3:
-            pattern = self._replacestar(toks)
-            return self.exist(["%s %s %s" % pattern])
-        else:
-            return True if self.lookup(pattern) else False
+        method, args = _contains_request(pattern)
+        return bool(self._call(method, args, {}, ("in", _query_key(pattern))))
     
     def __iadd__(self, stmts):
         """ This method allows to easily add new statements to the ontology
@@ -351,10 +1146,13 @@ class KB:
             kb += ["toto loves tata", "tata rdf:type Robot"]
 
         """
-        if not (type(stmts) == list):
-            stmts = [stmts]
-        
-        self.update(stmts)
+        batch = self._batch()
+        if batch is not None:
+            batch.add(_as_list(stmts))
+        elif self._write_behind:
+            self._write_behind.add(_as_list(stmts))
+        else:
+            self.update(_as_list(stmts))
         
         return self
 
@@ -372,218 +1170,2892 @@ class KB:
             kb -= ["toto loves tata", "tata rdf:type Robot"]
 
         """
-        if not (type(stmts) == list):
-            stmts = [stmts]
-        
-        self.retract(stmts)
+        batch = self._batch()
+        if batch is not None:
+            batch.retract(_as_list(stmts))
+        elif self._write_behind:
+            self._write_behind.retract(_as_list(stmts))
+        else:
+            self.retract(_as_list(stmts))
         
         return self
 
-    def _replacestar(self, pattern):
-        res = []
-        for tok in pattern:
-            if tok == '*':
-                res.append("?" + "".join(random.sample("abcdefghijklmopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ", 5)))
-            else:
-                res.append(tok)
-        return tuple(res)
+    def batch(self):
+        """ Returns a :class:`Batch`: within a ``with kb.batch():`` block, the
+        statements added with ``+=`` and retracted with ``-=`` (from the same
+        thread) are collected, and sent at the end of the block with at most
+        one ``retract`` and one ``update`` request.
 
+        .. code:: python
 
-class EmbeddedKBClient():
+            with kb.batch():
+                for obj in perceived:
+                    kb += ["%s isIn %s" % (obj, obj.location)]
+                kb -= ["cup1 isIn kitchen"]
+            # statements sent here
 
-    kb = None
-    kb_thread = None
-    kb_users = 0
+        If a statement is both added and retracted in the block, only the
+        last operation is kept. If the block raises an exception, the
+        collected statements are dropped. Batches can be nested: an inner
+        batch is merged into the outer one.
+        """
+        return Batch(self)
 
-    def __init__(self, defaultontology = None):
-        try:
-            from minimalkb.kb import MinimalKB
-        except ImportError:
-            raise KbError("Embedded kb required, but MinimalKB can not be imported!")
+    def _batch(self):
+        batches = getattr(self._local, "batches", None)
+        return batches[-1] if batches else None
 
-        minimalkblogger = logging.getLogger("minimalKB")
-        minimalkblogger.addHandler(NullHandler())
+    def enable_write_behind(self, max_statements = 1000, max_delay = 0.01, max_pending = 100000, on_error = None):
+        """ Makes ``+=`` and ``-=`` return immediately: the statements are
+        buffered, and written by a background thread as soon as
+        ``max_statements`` statements are buffered or the oldest one has been
+        waiting for ``max_delay`` seconds. Additions and retractions of the
+        same statement are coalesced as in :meth:`batch`.
 
+        At most ``max_pending`` statements are buffered: beyond that, ``+=``
+        and ``-=`` wait for the buffer to be written.
 
-        kblogger.warn("Using embedded kb: events are not yet supported!")
+        If a write fails, ``on_error(exception, retracted, added)`` is called
+        (from the background thread) with the statements that were not
+        written. Without ``on_error``, the exception is raised by the next
+        ``+=``, ``-=`` or :meth:`sync`.
 
-        if not EmbeddedKBClient.kb:
-            kblogger.info("Initializing the embedded knowledge base.")
-            self._running = True
-            EmbeddedKBClient.kb_thread = threading.Thread(target=self.process, kwargs = {"defaultontology":defaultontology})
-            EmbeddedKBClient.kb_thread.start()
-            while not hasattr(self, "_kb"):
-                time.sleep(0.01)
-        else:
-            self._kb = EmbeddedKBClient.kb
-            if defaultontology:
-                kblogger.warn("The embedded knowledge base has already been " + \
-                              "initialized. I will ignore default ontology <%s>." % defaultontology)
+        Reads do not wait for the buffered writes: call :meth:`sync` first
+        when a query must see the previous writes.
 
-        self._incoming_response = Queue()
+        .. code:: python
 
-        EmbeddedKBClient.kb_users += 1
+            kb.enable_write_behind(max_statements = 500, max_delay = 0.005)
+            kb += ["cup1 isOn table"] # returns immediately
+            kb.sync()
+            assert "cup1 isOn table" in kb
 
-    def call_server(self, method, *args, **kwargs):
-        self._kb.submitrequest(self, method, *args, **kwargs)
+        Returns the :class:`WriteBehind` buffer.
+        """
+        if self._write_behind:
+            self._write_behind.close()
+        self._write_behind = WriteBehind(self, max_statements, max_delay, max_pending, on_error)
+        self._write_behind.start()
+        return self._write_behind
+
+    def sync(self):
+        """ Waits until the statements buffered so far (see
+        :meth:`enable_write_behind`) are written. Raises the last write
+        error, if any.
+        """
+        if self._write_behind:
+            self._write_behind.sync()
 
-        # if we are closing, do not wait for an answer
-        if method == "close":
-            return None
+    def load_statements(self, source, chunk_size = 1000, max_in_flight = 4, offset = 0, progress = None, models = None):
+        """ Streams a large number of statements to the knowledge base.
 
-        # Block until a result is available
-        status, value = self._incoming_response.get()
+        ``source`` is either the path (a string or a :class:`os.PathLike`) to
+        a file with one statement per line
+        (N-Triples style: blank lines, ``#`` comments and the trailing ``.``
+        of each line are ignored), or any iterable of statements (like a
+        generator).
 
-        if status == KB_ERROR:
-            raise KbError(str(value))
-        else:
-            return value
+        Statements are sent by chunks of ``chunk_size`` statements, with at
+        most ``max_in_flight`` chunks waiting for the server's
+        acknowledgement at any time: the memory used does not depend on the
+        size of the source.
 
-    def sendmsg(self, msg):
-        self._incoming_response.put(msg)
+        ``progress``, if given, is called after each acknowledged chunk with
+        the number of statements loaded so far and the current throughput
+        (in statements per second).
 
-    def process(self, defaultontology):
-        from minimalkb.kb import MinimalKB
-        EmbeddedKBClient.kb = MinimalKB(defaultontology)
-        self._kb = EmbeddedKBClient.kb
-        while self._running:
-            EmbeddedKBClient.kb.process()
+        If a chunk fails, a :class:`KbLoadError` is raised. Its ``offset``
+        tells how many statements were loaded: pass it as ``offset`` to
+        resume the loading (the first ``offset`` statements of the source
+        are then skipped).
 
-    def close(self):
-        EmbeddedKBClient.kb_users -= 1
-        if EmbeddedKBClient.kb_users == 0:
-            kblogger.debug("Last user of the embedded knowledge base has left. " + \
-                           "Closing the knowledge base.")
-            self._running = False
-            EmbeddedKBClient.kb.stop_services()
-            EmbeddedKBClient.kb_thread.join()
-            EmbeddedKBClient.kb = None # reset kb to none so a new fresh thread may be created if needed.
+        .. code:: python
 
+            def report(loaded, rate):
+                print("%d statements loaded (%d stmts/s)" % (loaded, rate))
 
-class RemoteKBClient(asynchat.async_chat):
+            kb.load_statements("world.nt", chunk_size = 5000, progress = report)
 
-    use_encoding = 0 # Python2 compat.
+        Not to be confused with the server's own ``load`` method (like
+        MinimalKB's ontology loader), still available as ``kb.load(...)``.
 
-    def __init__(self, event_queue, map, host='localhost', port=DEFAULT_PORT, sock=None):
-        asynchat.async_chat.__init__(self, sock=sock, map=map)
-        if not sock:
-            self.create_socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-            self.connect( (host, port) )
+        Returns a dictionary with the number of statements and chunks sent,
+        the duration of the loading and the throughput.
+        """
+        if isinstance(source, (str, os.PathLike)):
+            with open(source) as f:
+                return self.load_statements(_statements(f), chunk_size, max_in_flight, offset, progress, models)
+
+        stmts = itertools.islice(source, offset, None)
+        loaded = offset
+        nb_chunks = 0
+        in_flight = deque() # (future, number of statements)
+        start = time.time()
+
+        def acknowledge():
+            future, size = in_flight.popleft()
+            try:
+                future.result()
+            except KbError as e:
+                raise KbLoadError("Loading failed after %d statements: %s" % (loaded, e.value), loaded)
+            if progress:
+                progress(loaded + size, (loaded + size - offset) / max(time.time() - start, 1e-6))
+            return size
 
-        self.host = host
-        self.port = port
+        while True:
+            chunk = list(itertools.islice(stmts, chunk_size))
+            if not chunk:
+                break
 
-        self.set_terminator(MSG_SEPARATOR)
-        self._in_buffer = b""
-        self._incoming_response = Queue()
+            if len(in_flight) >= max_in_flight:
+                loaded += acknowledge()
 
-        self._events = event_queue
+            args = (chunk, models) if models else (chunk,)
+            in_flight.append((self.submit("update", *args), len(chunk)))
+            nb_chunks += 1
 
-    def collect_incoming_data(self, data):
-        self._in_buffer = self._in_buffer + data
+        while in_flight:
+            loaded += acknowledge()
 
-    def found_terminator(self):
-        status, value = self.decode(self._in_buffer)
+        duration = time.time() - start
+        return {"statements": loaded - offset,
+                "chunks": nb_chunks,
+                "duration": duration,
+                "rate": (loaded - offset) / duration if duration else 0.}
 
-        if status == KB_EVENT:
-            kblogger.debug("Event received: %s (%s)" % value)
-            self._events.put(value)
-        else:
-            self._incoming_response.put((status, value))
 
-        self._in_buffer = b""
+class Batch(object):
+    """ Collects statements to add and to retract, and sends them to the
+    knowledge base in one go. See :meth:`KB.batch`.
+    """
 
-    def handle_error(self):
-        exctype, value = sys.exc_info()[:2]
+    def __init__(self, kb):
+        self._kb = kb
+        self._parent = None
+        # statement -> True if added, False if retracted. A statement is
+        # moved to the end each time it is modified, to keep the order of
+        # the last operations.
+        self._ops = OrderedDict()
+        self._lock = threading.Lock()
 
-        if exctype == socket.error and value.errno == ECONNREFUSED:
-            kblogger.error("Connection refused!")
-            self.handle_close()
-            return
-        if exctype == socket.error and value.errno in (EAGAIN, EWOULDBLOCK):
-            kblogger.warn("Resource not available. Will retry.")
-            return
+    def __enter__(self):
+        if not hasattr(self._kb._local, "batches"):
+            self._kb._local.batches = []
+        self._parent = self._kb._batch()
+        self._kb._local.batches.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._kb._local.batches.pop()
+        if exc_type is None:
+            self.flush()
+        else:
+            kblogger.warning("Exception in a batch: %d statement(s) dropped." % len(self._ops))
+            self._ops.clear()
 
-        kblogger.error("Unhandled exception: %s: %s" % (exctype, value))
-        traceback.print_exc()
+    def add(self, stmts):
+        self._record(stmts, True)
 
-        raise value
+    def retract(self, stmts):
+        self._record(stmts, False)
 
-    def call_server(self, method, *args, **kwargs):
-        self.push(self.encode(method, *args, **kwargs))
+    def _record(self, stmts, add):
+        with self._lock:
+            for stmt in stmts:
+                stmt = " ".join(_tokenize(stmt))
+                self._ops.pop(stmt, None)
+                self._ops[stmt] = add
 
-        status, value = None, None
-        while True:
-            try:
-                status, value = self._incoming_response.get(True, 0.01)
-                break
-            except Empty:
-                if not self.connected:
-                    # Connection closed!
-                    self.close()
-                    break
+    def __len__(self):
+        return len(self._ops)
 
-        if status == KB_ERROR:
-            raise KbError(value)
-        else:
-            return value
+    def flush(self):
+        """ Sends the collected statements (to the enclosing batch, or to the
+        write-behind buffer, if any).
+        """
+        retracted, added = self._take()
 
-    def encode(self, method, *args, **kwargs):
-        return "\n".join([method] + \
-                         [json.dumps(a) for a in args] + \
-                         ([json.dumps({"kwargs":kwargs})] if kwargs else []) + \
-                         [MSG_SEPARATOR])
+        target = self._parent if self._parent is not None else self._kb._write_behind
+        if target:
+            target.retract(retracted)
+            target.add(added)
+            return
 
-    def decode(self, raw):
-        parts = raw.strip().split('\n')
+        _write(self._kb, retracted, added)
 
-        if parts[0] == "ok":
-            if len(parts) > 1:
-                return "ok", json.loads(parts[1])
-            else:
-                return "ok", None
-        elif parts[0] == "event":
-            return "event", (parts[1], json.loads(parts[2]))
-        elif parts[0] == "error":
-            return "error", "%s: %s"%(parts[1], parts[2] if len(parts) == 3 else "[no error msg]")
-        else:
-            raise KbError("Got an unexpected message status from the knowledge base: %s"%parts[0])
-
-    #### patch code from asynchat, ``del deque[0]`` is not safe #####
-    def initiate_send(self):
-        while self.producer_fifo and self.connected:
-            first = self.producer_fifo.popleft()
-            # handle empty string/buffer or None entry
-            if not first:
-                if first is None:
-                    self.handle_close()
-                    return
+    def _take(self):
+        """ Empties the batch. Returns the retracted and added statements.
+        """
+        with self._lock:
+            ops, self._ops = self._ops, OrderedDict()
 
-            # handle classic producer behavior
-            obs = self.ac_out_buffer_size
-            try:
-                data = first[:obs]
-            except TypeError:
-                data = first.more()
-                if data:
-                    self.producer_fifo.appendleft(data)
-                continue
+        return [stmt for stmt, add in ops.items() if not add], \
+               [stmt for stmt, add in ops.items() if add]
 
-            if isinstance(data, str) and self.use_encoding:
-                data = bytes(data, self.encoding)
 
-            # send the data
-            try:
-                num_sent = self.send(data)
-            except socket.error:
-                self.handle_error()
-                return
+def _statements(lines):
+    """ Yields the statements of a N-Triples-like file.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.endswith('.'):
+            line = line[:-1].rstrip()
+        yield line
+
+def _write(kb, retracted, added):
+    # both requests are pipelined
+    futures = []
+    if retracted:
+        futures.append(kb.submit("retract", retracted))
+    if added:
+        futures.append(kb.submit("update", added))
+    for future in futures:
+        future.result()
+
+
+class KBMirror(object):
+    """ A local copy of the statements that match a set of patterns, indexed
+    to answer queries without going through the network. See
+    :meth:`KB.mirror`.
+    """
 
-            if num_sent:
-                if num_sent < len(data) or obs < len(first):
-                    self.producer_fifo.appendleft(first[num_sent:])
-            # we tried to send some actual data
-            return
+    def __init__(self, kb, patterns, models = None, refresh_interval = 10.):
+        self._kb = kb
+        self.models = models
+        self.refresh_interval = refresh_interval
+
+        self._patterns = []
+        for pattern in _as_list(patterns):
+            toks = _tokenize(pattern)
+            if len(toks) != 3:
+                raise KbError("A mirror is defined by 's p o' patterns, got '%s'" % pattern)
+            self._patterns.append(_tokenize(_expand((toks,))[0][0]))
+
+        self._lock = threading.RLock()
+        self._statements = set()
+        # s -> p -> {o}, p -> o -> {s} and o -> s -> {p}
+        self._spo = {}
+        self._pos = {}
+        self._osp = {}
+        # statements added by events while a refresh is running, one set
+        # per running refresh: see refresh()
+        self._recent = []
+
+        self.last_refresh = None
+        self.last_event = None
+        self.refreshes = 0
+        self.events = 0
+        self.local_queries = 0
+        self.forwarded_queries = 0
+        self._closed = False
+        self._stop = threading.Event()
+
+        # subscribes before loading, not to miss the statements added
+        # meanwhile. (event id, callback) of each subscription
+        self._subscriptions = []
+        for toks in self._patterns:
+            for var in set(_variables(toks)):
+                callback = self._event_callback(toks, var)
+                event_id = kb.subscribe(" ".join(toks), callback, var = var, models = models)
+                self._subscriptions.append((event_id, callback))
+        self.refresh()
+
+        if refresh_interval:
+            refresher = threading.Thread(target = self._refresh_loop, name = "kb-mirror")
+            refresher.daemon = True
+            refresher.start()
+
+    #### synchronization ####
+    def refresh(self):
+        """ Reloads the matching statements, and applies the differences to
+        the mirror. Called every ``refresh_interval`` seconds.
+        """
+        recent = set()
+        with self._lock:
+            self._recent.append(recent)
+
+        try:
+            futures = [(toks, self._fetch(toks)) for toks in self._patterns]
+            fresh = set()
+            for toks, future in futures:
+                fresh.update(self._matching(toks, future.result()))
+
+            with self._lock:
+                for stmt in self._statements - fresh - recent:
+                    self._remove(stmt)
+                for stmt in fresh - self._statements:
+                    self._add(stmt)
+                self.last_refresh = time.time()
+                self.refreshes += 1
+        finally:
+            with self._lock:
+                self._recent.remove(recent)
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            if self._kb._closed:
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                kblogger.error("Could not refresh the mirror of the knowledge base: %s" % e)
+
+    def _fetch(self, toks):
+        vars = _variables(toks)
+        if not vars:
+            return self._kb.submit("exist", [" ".join(toks)], self.models)
+        # not through the cache of the KB, that may be staler than the mirror
+        return self._kb.submit("find", vars, [" ".join(toks)], None, self.models)
+
+    def _matching(self, toks, rows):
+        """ Rebuilds the statements matching ``toks`` from the response of
+        :meth:`_fetch`.
+        """
+        vars = _variables(toks)
+        if not vars:
+            return [toks] if rows else []
+
+        stmts = []
+        for row in rows:
+            if len(vars) == 1:
+                binding = {vars[0]: row}
+            else:
+                binding = dict((v, row[v[1:]]) for v in vars)
+            stmts.append(tuple(_intern(binding[t]) if t in binding else t for t in toks))
+        return stmts
+
+    def _event_callback(self, toks, var):
+        def onnewinstances(instances):
+            self._on_new_instances(toks, var, instances)
+        return onnewinstances
+
+    def _on_new_instances(self, toks, var, instances):
+        if self._closed:
+            return
+
+        # fetches the statements of the new instances, in parallel
+        bound = [tuple(instance if t == var else t for t in toks) for instance in instances]
+        futures = [(b, self._fetch(b)) for b in bound]
+        stmts = []
+        for b, future in futures:
+            stmts.extend(self._matching(b, future.result()))
+
+        with self._lock:
+            self.events += 1
+            self.last_event = time.time()
+            for stmt in stmts:
+                self._add(stmt)
+            for recent in self._recent:
+                recent.update(stmts)
+
+    def _add(self, stmt):
+        if stmt in self._statements:
+            return
+        self._statements.add(stmt)
+        s, p, o = stmt
+        self._spo.setdefault(s, {}).setdefault(p, set()).add(o)
+        self._pos.setdefault(p, {}).setdefault(o, set()).add(s)
+        self._osp.setdefault(o, {}).setdefault(s, set()).add(p)
+
+    def _remove(self, stmt):
+        self._statements.discard(stmt)
+        s, p, o = stmt
+        for index, (a, b, c) in ((self._spo, (s, p, o)), (self._pos, (p, o, s)), (self._osp, (o, s, p))):
+            inner = index[a]
+            inner[b].discard(c)
+            if not inner[b]:
+                del inner[b]
+                if not inner:
+                    del index[a]
+
+    #### queries ####
+    def __getitem__(self, *args):
+        """ Same as :meth:`KB.__getitem__`. Queries whose patterns are all
+        covered by the patterns of the mirror (and on the same models) are
+        answered locally, the others by the knowledge base.
+        """
+        method, query, row = _getitem_request(args[0])
+        if method == "find" and query[3] == self.models and self._covers(query[1]):
+            return self._find(query[0], query[1])
+
+        with self._lock:
+            self.forwarded_queries += 1
+        return self._kb.__getitem__(*args)
+
+    def __contains__(self, pattern):
+        """ Same as :meth:`KB.__contains__`, answered locally if the
+        statement is covered by the mirror (without models).
+        """
+        method, args = _contains_request(pattern)
+        if method == "exist" and self.models is None and self._covers(args[0]):
+            return bool(self._find((), args[0], limit = 1))
+
+        with self._lock:
+            self.forwarded_queries += 1
+        return pattern in self._kb
+
+    def _covers(self, patterns):
+        for pattern in patterns:
+            toks = _tokenize(pattern)
+            if not any(self._pattern_covers(m, toks) for m in self._patterns):
+                return False
+        return True
+
+    @staticmethod
+    def _pattern_covers(mirrored, toks):
+        vars = _variables(mirrored)
+        if len(vars) != sum(1 for t in mirrored if t.startswith('?')):
+            # a repeated variable constrains the statements: not handled
+            return False
+        return all(m.startswith('?') or m == t for m, t in zip(mirrored, toks))
+
+    def _find(self, vars, patterns, limit = None):
+        patterns = [_tokenize(p) for p in patterns]
+        res = []
+        seen = set()
+        with self._lock:
+            self.local_queries += 1
+            for binding in self._solve(patterns, {}):
+                key = tuple(binding[v] for v in vars)
+                if key in seen:
+                    continue
+                seen.add(key)
+                res.append(key[0] if len(vars) == 1 else dict((v[1:], b) for v, b in zip(vars, key)))
+                if limit and len(res) >= limit:
+                    break
+        return res
+
+    def _solve(self, patterns, binding):
+        """ Yields the bindings of the variables that satisfy all the
+        patterns, starting with the most bound pattern.
+        """
+        if not patterns:
+            yield binding
+            return
+
+        resolved = [tuple(binding.get(t) if t.startswith('?') else t for t in p) for p in patterns]
+        i = max(range(len(patterns)), key = lambda i: sum(t is not None for t in resolved[i]))
+        pattern, rest = patterns[i], patterns[:i] + patterns[i + 1:]
+
+        for stmt in self._candidates(*resolved[i]):
+            candidate = dict(binding)
+            for tok, value in zip(pattern, stmt):
+                if tok.startswith('?') and candidate.setdefault(tok, value) != value:
+                    break
+            else:
+                for b in self._solve(rest, candidate):
+                    yield b
+
+    def _candidates(self, s, p, o):
+        """ Yields the statements matching the bound terms (None for the
+        unbound ones), through the most selective index.
+        """
+        if s is not None:
+            by_p = self._spo.get(s, {})
+            if p is not None:
+                objects = by_p.get(p, ())
+                if o is not None:
+                    if o in objects:
+                        yield s, p, o
+                    return
+                for obj in objects:
+                    yield s, p, obj
+            elif o is not None:
+                for pred in self._osp.get(o, {}).get(s, ()):
+                    yield s, pred, o
+            else:
+                for pred, objects in by_p.items():
+                    for obj in objects:
+                        yield s, pred, obj
+        elif p is not None:
+            by_o = self._pos.get(p, {})
+            if o is not None:
+                for subj in by_o.get(o, ()):
+                    yield subj, p, o
+            else:
+                for obj, subjects in by_o.items():
+                    for subj in subjects:
+                        yield subj, p, obj
+        elif o is not None:
+            for subj, predicates in self._osp.get(o, {}).items():
+                for pred in predicates:
+                    yield subj, pred, o
+        else:
+            for stmt in self._statements:
+                yield stmt
+
+    #### reporting ####
+    def staleness(self):
+        """ Returns the number of seconds since the last complete refresh.
+
+        New statements are normally mirrored as soon as their event is
+        received, but retracted statements (and additions not signalled by
+        an event, like a new value for a known instance) are only noticed
+        by the periodic refresh: the mirror may miss these changes for up
+        to ``staleness()`` seconds.
+        """
+        return time.time() - self.last_refresh
+
+    def memory(self):
+        """ Returns an estimate of the memory used by the mirror, in bytes.
+        """
+        with self._lock:
+            size = sys.getsizeof(self._statements)
+            terms = set()
+            for stmt in self._statements:
+                size += sys.getsizeof(stmt)
+                terms.update(stmt)
+            for index in (self._spo, self._pos, self._osp):
+                size += sys.getsizeof(index)
+                for inner in index.values():
+                    size += sys.getsizeof(inner) + sum(sys.getsizeof(leaf) for leaf in inner.values())
+            return size + sum(sys.getsizeof(t) for t in terms)
+
+    def stats(self):
+        with self._lock:
+            return {"statements": len(self._statements),
+                    "memory": self.memory(),
+                    "staleness": self.staleness(),
+                    "last_refresh": self.last_refresh,
+                    "last_event": self.last_event,
+                    "refreshes": self.refreshes,
+                    "events": self.events,
+                    "local_queries": self.local_queries,
+                    "forwarded_queries": self.forwarded_queries}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """ Stops updating the mirror. """
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        if not self._kb._closed:
+            for event_id, callback in self._subscriptions:
+                self._kb.unsubscribe(event_id, callback)
+
+def _variables(toks):
+    """ Returns the distinct variables of a tokenized pattern, in order. """
+    vars = []
+    for tok in toks:
+        if tok.startswith('?') and tok not in vars:
+            vars.append(tok)
+    return vars
+
+
+class WriteBehind(threading.Thread):
+    """ Buffers statements to add and to retract, and writes them to the
+    knowledge base from a background thread. See
+    :meth:`KB.enable_write_behind`.
+    """
+
+    def __init__(self, kb, max_statements = 1000, max_delay = 0.01, max_pending = 100000, on_error = None):
+        threading.Thread.__init__(self, name = "kb-write-behind")
+        self.daemon = True
+
+        self._kb = kb
+        self.max_statements = max_statements
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.on_error = on_error
+
+        self._buffer = Batch(kb)
+        self._cond = threading.Condition()
+        # time at which the oldest buffered statement was added
+        self._oldest = None
+        # number of operations buffered so far, and number of these that
+        # have been written (or failed): see sync()
+        self._buffered = 0
+        self._written = 0
+        self._error = None
+        self._flush_requested = False
+        self._closing = False
+
+    def add(self, stmts):
+        self._record(stmts, True)
+
+    def retract(self, stmts):
+        self._record(stmts, False)
+
+    def _record(self, stmts, add):
+        if not stmts:
+            return
+        self._raise_error()
+
+        with self._cond:
+            while len(self._buffer) >= self.max_pending and not self._closing:
+                self._cond.wait()
+            if self._closing:
+                raise KbError("The write-behind buffer is closed.")
+
+            self._buffer._record(stmts, add)
+            self._buffered += len(stmts)
+            if self._oldest is None:
+                # wakes the writer up, to arm the max_delay timer
+                self._oldest = time.time()
+                self._cond.notify_all()
+            elif len(self._buffer) >= self.max_statements:
+                self._cond.notify_all()
+
+    def _raise_error(self):
+        with self._cond:
+            error, self._error = self._error, None
+        if error:
+            raise error
+
+    def sync(self):
+        with self._cond:
+            target = self._buffered
+            if self._written < target:
+                self._flush_requested = True
+                self._cond.notify_all()
+                while self._written < target:
+                    self._cond.wait()
+            if not len(self._buffer):
+                # not to force the next small write out early
+                self._flush_requested = False
+        self._raise_error()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while True:
+                    pending = len(self._buffer)
+                    if pending and (pending >= self.max_statements or self._flush_requested or self._closing):
+                        break
+                    if self._closing:
+                        return
+                    if pending:
+                        remaining = self._oldest + self.max_delay - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+
+                self._flush_requested = False
+                retracted, added = self._buffer._take()
+                buffered = self._buffered
+                self._oldest = None
+                self._cond.notify_all()
+
+            try:
+                _write(self._kb, retracted, added)
+            except KbError as e:
+                if self.on_error:
+                    try:
+                        self.on_error(e, retracted, added)
+                    except Exception as e:
+                        kblogger.error("Exception in the write error callback: %s" % e)
+                else:
+                    with self._cond:
+                        self._error = e
+
+            with self._cond:
+                self._written = buffered
+                self._cond.notify_all()
+
+    def close(self):
+        """ Writes the remaining statements and stops the background thread.
+        Raises the last write error, if any.
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self.join()
+        self._raise_error()
+
+
+# a token is either a quoted literal (possibly followed by a language tag or
+# a datatype) or anything up to the next whitespace
+_token = re.compile(r'''"(?:[^"\\]|\\.)*"\S*|'(?:[^'\\]|\\.)*'\S*|\S+''')
+
+@lru_cache(maxsize = 4096)
+def _tokenize(pattern):
+    """ Splits a pattern into its tokens. Quoted literals are kept as they
+    are (quotes and inner whitespaces included), so that the pattern can be
+    rebuilt from its tokens.
+    """
+    return tuple(_token.findall(pattern))
+
+@lru_cache(maxsize = 4096)
+def _expand(patterns):
+    """ Replaces the '*' tokens of a tuple of tokenized patterns by
+    variables, named after their position in the patterns (``?_star0``,
+    ``?_star1``, ...) so that identical queries result in identical
+    requests.
+
+    Returns the tuple of the rebuilt patterns, and the tuple of their
+    variables, in order of appearance.
+    """
+    stars = 0
+    res = []
+    vars = []
+    for pattern in patterns:
+        toks = []
+        for tok in pattern:
+            if tok == '*':
+                tok = "?_star%d" % stars
+                stars += 1
+            if tok.startswith('?') and tok not in vars:
+                vars.append(tok)
+            toks.append(tok)
+        res.append(" ".join(toks))
+    return tuple(res), tuple(vars)
+
+def _concept_id(concept):
+    return concept[0]
+
+def _getitem_request(args):
+    """ Translates the argument of :meth:`KB.__getitem__` into the request
+    to send to the server.
+
+    Returns a tuple ``(method, args, row)``, where ``row`` is either None or
+    a function to apply to each element of the server's response.
+    """
+    # First, take care of models
+    models = None
+    if len(args) > 1 and isinstance(args[-1], list):
+        models = args[-1]
+        args = args[:-1]
+
+    # Single argument
+    if isinstance(args, str) or len(args) == 1:
+        pattern = args if isinstance(args, str) else args[0]
+        toks = _tokenize(pattern)
+        if len(toks) == 3:
+            patterns, vars = _expand((toks,))
+            return "find", (list(vars), list(patterns), None, models), None
+        else:
+            return "lookup", (pattern, models), _concept_id
+
+    # List of patterns
+    else:
+        patterns, vars = _expand(tuple(_tokenize(p) for p in args))
+        return "find", (list(vars), list(patterns), None, models), None
+
+def _query_key(args):
+    """ Normalizes the patterns (and models) of a query, to be used as a
+    cache key.
+    """
+    if isinstance(args, str):
+        return " ".join(_tokenize(args))
+    return tuple(_query_key(a) if isinstance(a, str) else tuple(sorted(a)) for a in args)
+
+def _contains_request(pattern):
+    """ Same as :func:`_getitem_request`, for :meth:`KB.__contains__`.
+    Returns a ``(method, args)`` pair: the truth value of the response is
+    the result.
+    """
+    toks = _tokenize(pattern)
+    if len(toks) == 3:
+        patterns, vars = _expand((toks,))
+        return "exist", (list(patterns),)
+    else:
+        return "lookup", (pattern,)
+
+def _subscription(pattern, var, type):
+    """ Normalizes the pattern and the returned variable of an event
+    subscription. See :meth:`KB.subscribe`.
+    """
+    if isinstance(pattern, str):
+        pattern = [pattern]
+
+    if var and not var.startswith('?'):
+        var = '?' + var
+
+    if type == 'NEW_INSTANCE' and not var:
+        #Look if there's more than one variable in the pattern
+        vars = set()
+        for ps in pattern:
+            vars |= set([s for s in _tokenize(ps) if s[0] == '?'])
+        if len(vars) > 1:
+            raise AttributeError("You must specify which variable must be returned " + \
+            "when the event is triggered by setting the 'var' parameter")
+        if len(vars) == 1:
+            var = vars.pop()
+
+    return pattern, var
+
+def _gather(requests):
+    """ Waits for the responses of a list of ``(future, convert)`` pairs,
+    and returns them (converted if ``convert`` is not None), in order. Errors
+    are returned in place of the response.
+    """
+    results = []
+    for future, convert in requests:
+        try:
+            res = future.result()
+        except KbError as e:
+            results.append(e)
+        else:
+            results.append(convert(res) if convert else res)
+    return results
+
+def _as_list(stmts):
+    return stmts if type(stmts) == list else [stmts]
+
+
+class EmbeddedKBClient():
+    """ Connection to a MinimalKB running in the same process, shared by
+    all the embedded clients.
+
+    By default, requests are queued to the MinimalKB, which processes them
+    in its own thread. With ``direct = True``, requests are instead executed
+    right away by the calling thread: there is no thread handoff, which
+    makes calls much faster. Direct requests are serialized with a lock
+    shared by all the embedded clients, also held by the MinimalKB thread
+    while it processes the queued requests. While direct clients are
+    connected, that thread only runs when requests of other clients are
+    queued (a direct request may then wait for one of its processing
+    steps): the direct requests deliver the answers and the events queued
+    by the MinimalKB themselves, which is all that thread does besides
+    executing the queued requests. The direct mode requires a MinimalKB
+    with an ``execute`` method: otherwise, requests are queued.
+
+    Events triggered by the MinimalKB are put in the event queue as
+    ``(event id, value)`` pairs (without any serialization), like the
+    remote client does.
+    """
+
+    kb = None
+    kb_thread = None
+    kb_users = 0
+    running = False
+    # serializes the direct requests, and the processing steps of the
+    # MinimalKB thread
+    lock = threading.Lock()
+    # number of direct clients, and of queued requests waiting for their
+    # answer: see process()
+    direct_users = 0
+    queued = 0
+    cond = threading.Condition()
+
+    def __init__(self, event_queue, defaultontology = None, direct = False):
+        try:
+            from minimalkb.kb import MinimalKB
+        except ImportError:
+            raise KbError("Embedded kb required, but MinimalKB can not be imported!")
+
+        minimalkblogger = logging.getLogger("minimalKB")
+        minimalkblogger.addHandler(NullHandler())
+
+        self._events = event_queue
+
+        if not EmbeddedKBClient.kb:
+            kblogger.info("Initializing the embedded knowledge base.")
+            EmbeddedKBClient.running = True
+            self._error = None
+            ready = threading.Event()
+            EmbeddedKBClient.kb_thread = threading.Thread(target=self.process, args = (defaultontology, ready))
+            EmbeddedKBClient.kb_thread.start()
+            ready.wait()
+            if self._error:
+                raise KbError("Could not initialize the embedded knowledge base: %s" % self._error)
+        else:
+            self._kb = EmbeddedKBClient.kb
+            if defaultontology:
+                kblogger.warning("The embedded knowledge base has already been " + \
+                              "initialized. I will ignore default ontology <%s>." % defaultontology)
+
+        # futures of the pending requests, in submission order. MinimalKB
+        # processes the requests in order, so each answer goes to the oldest
+        # pending future.
+        self._pending = deque()
+        self._submit_lock = threading.Lock()
+
+        self.direct = direct
+        if direct and not hasattr(self._kb, "execute"):
+            kblogger.warning("This version of MinimalKB can not execute requests directly. " + \
+                             "Requests will be queued.")
+            self.direct = False
+
+        EmbeddedKBClient.kb_users += 1
+        if self.direct:
+            with EmbeddedKBClient.cond:
+                EmbeddedKBClient.direct_users += 1
+
+    def call_server(self, method, *args, **kwargs):
+        return self.call_server_async(method, *args, **kwargs).result()
+
+    def call_server_async(self, method, *args, **kwargs):
+        future = Future()
+
+        # if we are closing, do not wait for an answer
+        if method == "close":
+            self._kb.submitrequest(self, method, *args, **kwargs)
+            future.set_result(None)
+            return future
+
+        if self.direct:
+            return self._execute(future, method, args, kwargs)
+
+        with EmbeddedKBClient.cond:
+            EmbeddedKBClient.queued += 1
+            EmbeddedKBClient.cond.notify_all()
+        with self._submit_lock:
+            self._pending.append(future)
+            self._kb.submitrequest(self, method, *args, **kwargs)
+
+        return future
+
+    def _execute(self, future, method, args, kwargs):
+        with EmbeddedKBClient.lock:
+            self._pending.append(future)
+            try:
+                self._kb.execute(self, method, *args, **kwargs)
+            except Exception as e:
+                self._pending.remove(future)
+                future.set_exception(KbError("%s: %s" % (e.__class__.__name__, e)))
+            self._deliver()
+        return future
+
+    def _deliver(self):
+        # MinimalKB queues the answers and the events of each client, and
+        # sends them from process(): with the MinimalKB thread idle, the
+        # direct requests send them instead (called with the lock held)
+        for client, messages in list(self._kb.requestresults.items()):
+            while not messages.empty():
+                client.sendmsg(messages.get())
+
+    def sendmsg(self, msg):
+        status, value = msg
+        if status == KB_EVENT:
+            # MinimalKB sends its Event object
+            kblogger.debug("Event received: %s (%s)" % (value.id, value.content))
+            self._events.put((value.id, value.content))
+            return
+
+        try:
+            future = self._pending.popleft()
+        except IndexError:
+            # answer to a 'close' request
+            return
+
+        if not self.direct:
+            with EmbeddedKBClient.cond:
+                EmbeddedKBClient.queued -= 1
+
+        if status == KB_ERROR:
+            future.set_exception(KbError(str(value)))
+        else:
+            future.set_result(value)
+
+    def process(self, defaultontology, ready):
+        from minimalkb.kb import MinimalKB
+        try:
+            EmbeddedKBClient.kb = MinimalKB(defaultontology)
+            self._kb = EmbeddedKBClient.kb
+        except Exception as e:
+            self._error = e
+            return
+        finally:
+            ready.set()
+        cond = EmbeddedKBClient.cond
+        while EmbeddedKBClient.running:
+            with cond:
+                # the direct requests are executed by the callers: the
+                # MinimalKB is left to them when nothing is queued
+                while EmbeddedKBClient.running and EmbeddedKBClient.direct_users and not EmbeddedKBClient.queued:
+                    cond.wait()
+            with EmbeddedKBClient.lock:
+                EmbeddedKBClient.kb.process()
+
+    def close(self):
+        with EmbeddedKBClient.cond:
+            if self.direct:
+                EmbeddedKBClient.direct_users -= 1
+            EmbeddedKBClient.cond.notify_all()
+
+        EmbeddedKBClient.kb_users -= 1
+        if EmbeddedKBClient.kb_users == 0:
+            kblogger.debug("Last user of the embedded knowledge base has left. " + \
+                           "Closing the knowledge base.")
+            with EmbeddedKBClient.cond:
+                EmbeddedKBClient.running = False
+                EmbeddedKBClient.cond.notify_all()
+            EmbeddedKBClient.kb.stop_services()
+            EmbeddedKBClient.kb_thread.join()
+            EmbeddedKBClient.kb = None # reset kb to none so a new fresh thread may be created if needed.
+
+
+def encode(method, *args, **kwargs):
+    """ Serializes a request to the knowledge base.
+    """
+    return "\n".join([method] + \
+                     [json.dumps(a) for a in args] + \
+                     ([json.dumps({"kwargs":kwargs})] if kwargs else []) + \
+                     [MSG_SEPARATOR])
+
+_json_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'\s*')
+_bytes_whitespace = re.compile(br'\s*')
+
+def _next_line(raw, pos):
+    """ Returns the line of ``raw`` starting at ``pos``, and the position of
+    the following line.
+    """
+    end = raw.find('\n', pos)
+    if end < 0:
+        end = len(raw)
+    return raw[pos:end].strip(), end + 1
+
+def _json_at(raw, pos):
+    """ Decodes the JSON value found at ``pos`` in ``raw``, without copying
+    the rest of the message.
+    """
+    pos = _whitespace.match(raw, pos).end()
+    return _json_decoder.raw_decode(raw, pos)[0]
+
+def decode(raw):
+    """ Deserializes a message from the knowledge base (without its trailing
+    separator). Returns a ``(status, value)`` pair.
+
+    Only the status line (and the event id, for events) are split from the
+    message: the JSON payload is decoded in place.
+    """
+    if not isinstance(raw, str):
+        raw = str(raw, "utf-8")
+
+    status, pos = _next_line(raw, _whitespace.match(raw).end())
+
+    if status == "ok":
+        if _whitespace.match(raw, pos).end() < len(raw):
+            return "ok", _json_at(raw, pos)
+        else:
+            return "ok", None
+    elif status == "event":
+        eventid, pos = _next_line(raw, pos)
+        return "event", (eventid, _json_at(raw, pos))
+    elif status == "error":
+        parts = raw[pos:].strip().split('\n')
+        return "error", "%s: %s"%(parts[0], parts[1] if len(parts) == 2 else "[no error msg]")
+    else:
+        raise KbError("Got an unexpected message status from the knowledge base: %s"%status)
+
+
+class MessageParser(object):
+    """ Splits the byte stream coming from the knowledge base into messages.
+
+    This class does not do any I/O: the clients feed it with whatever they
+    read from their connection. Incoming data is appended to a single
+    buffer, and only the new data is searched for the message separator,
+    so that receiving a large message takes linear time.
+
+    ``stream_for``, if given, is called as soon as the status line of a
+    successful response is received. If it returns a sink (like a
+    :class:`ResultStream`), the payload of the response is passed to the
+    sink's ``feed`` method as it arrives instead of being buffered, and the
+    message is returned as ``("ok", None)`` once complete.
+    """
+
+    def __init__(self, stream_for = None):
+        self._terminator = MSG_SEPARATOR.encode()
+        self._in_buffer = bytearray()
+        # where to resume the search for the terminator
+        self._scan_from = 0
+
+        self._stream_for = stream_for
+        # whether the status line of the current message was already checked
+        self._status_checked = False
+        self._stream = None
+        self._text_decoder = None
+
+        # bytes consumed from the stream, and size of the last message
+        self._consumed = 0
+        self._message_start = 0
+        self.message_size = 0
+
+    def feed(self, data):
+        """ Adds incoming data, and yields the ``(status, value)`` messages
+        that are now complete.
+
+        The caller must be done with a message before the next one is
+        parsed, since ``stream_for`` depends on the pending requests.
+        """
+        self._in_buffer += data
+
+        while True:
+            if self._stream_for and not self._status_checked:
+                self._check_status()
+
+            idx = self._in_buffer.find(self._terminator, self._scan_from)
+
+            if self._stream:
+                # hand over everything that can not be part of the terminator
+                end = idx if idx >= 0 else max(0, len(self._in_buffer) - len(self._terminator) + 1)
+                if end:
+                    with memoryview(self._in_buffer) as view:
+                        text = self._text_decoder.decode(view[:end])
+                    del self._in_buffer[:end]
+                    self._consumed += end
+                    self._stream.feed(text)
+                if idx < 0:
+                    self._scan_from = 0
+                    break
+
+                del self._in_buffer[:len(self._terminator)]
+                self._consumed += len(self._terminator)
+                self._stream.feed(self._text_decoder.decode(b"", True))
+                self._stream = None
+                self._status_checked = False
+                self._message_done()
+                yield KB_OK, None
+                continue
+
+            if idx < 0:
+                # the terminator may be split between this chunk and the next one
+                self._scan_from = max(0, len(self._in_buffer) - len(self._terminator) + 1)
+                break
+
+            with memoryview(self._in_buffer) as view:
+                raw = str(view[:idx], "utf-8")
+            # deleting the head of a bytearray does not move the rest of it
+            del self._in_buffer[:idx + len(self._terminator)]
+            self._consumed += idx + len(self._terminator)
+            self._scan_from = 0
+            self._status_checked = False
+            self._message_done()
+
+            yield decode(raw)
+
+    def _message_done(self):
+        self.message_size = self._consumed - self._message_start
+        self._message_start = self._consumed
+
+    def _check_status(self):
+        start = _bytes_whitespace.match(self._in_buffer).end()
+        eol = self._in_buffer.find(b"\n", start)
+        if eol < 0:
+            # status line not complete yet
+            return
+
+        self._status_checked = True
+        if self._in_buffer[start:eol].strip() != KB_OK.encode():
+            return
+
+        self._stream = self._stream_for()
+        if self._stream:
+            del self._in_buffer[:eol + 1]
+            self._consumed += eol + 1
+            self._scan_from = 0
+            self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+
+
+#### binary protocol ####
+# Negotiated when connecting (see RemoteKBClient.negotiate): each message is
+# a frame made of a header (length of the body, flags) followed by the body,
+# the encoding (msgpack, CBOR or JSON) of:
+#  - [method, args, kwargs] for the requests,
+#  - [status, value] for the responses and events. The value of an error is
+#    its "type: message" description, and the value of an event is
+#    [event id, content].
+# If the FRAME_COMPRESSED flag is set, the body is compressed with the
+# negotiated compression.
+
+FRAME_HEADER = struct.Struct("!IB")
+FRAME_COMPRESSED = 1
+
+@lru_cache(maxsize = None)
+def _available_codecs():
+    """ Returns the codecs available for the binary protocol, by order of
+    preference: an ordered dict of name -> (dumps, loads).
+    """
+    codecs = OrderedDict()
+    try:
+        import msgpack
+        codecs["msgpack"] = (msgpack.packb, lambda data: msgpack.unpackb(data, raw = False))
+    except ImportError:
+        pass
+    try:
+        import cbor2
+        codecs["cbor"] = (cbor2.dumps, cbor2.loads)
+    except ImportError:
+        pass
+    codecs["json"] = (lambda value: json.dumps(value).encode("utf-8"), json.loads)
+    return codecs
+
+@lru_cache(maxsize = None)
+def _available_compressions():
+    """ Returns the compressions available for the binary protocol, by
+    order of preference: an ordered dict of name -> (compress, decompress).
+    """
+    compressions = OrderedDict()
+    try:
+        import zstandard
+        compressions["zstd"] = (zstandard.compress, zstandard.decompress)
+    except ImportError:
+        pass
+    try:
+        import lz4.frame
+        compressions["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+    except ImportError:
+        pass
+    import zlib
+    compressions["zlib"] = (lambda data: zlib.compress(data, 1), zlib.decompress)
+    return compressions
+
+def encode_frame(dumps, value, flags = 0):
+    body = dumps(value)
+    return FRAME_HEADER.pack(len(body), flags) + body
+
+
+class FrameParser(object):
+    """ Splits the byte stream of the binary protocol into frames, and
+    decodes them with ``loads``. Like :class:`MessageParser`, it does not do
+    any I/O.
+
+    Unlike the text protocol, the size of each message is known in advance:
+    the incoming data is not searched for a separator.
+    """
+
+    def __init__(self, loads, decompress = None):
+        self._loads = loads
+        self._decompress = decompress
+        self._in_buffer = bytearray()
+        # size of the last message
+        self.message_size = 0
+
+    def feed(self, data):
+        """ Adds incoming data, and yields the ``(status, value)`` messages
+        that are now complete.
+        """
+        self._in_buffer += data
+
+        while len(self._in_buffer) >= FRAME_HEADER.size:
+            length, flags = FRAME_HEADER.unpack_from(self._in_buffer)
+            end = FRAME_HEADER.size + length
+            if len(self._in_buffer) < end:
+                break
+
+            with memoryview(self._in_buffer) as view:
+                body = bytes(view[FRAME_HEADER.size:end])
+            del self._in_buffer[:end]
+            self.message_size = end
+
+            yield self._decode(body, flags)
+
+    def _decode(self, body, flags):
+        if flags & FRAME_COMPRESSED:
+            if not self._decompress:
+                raise KbError("Got a compressed message, but no compression was negotiated")
+            try:
+                body = self._decompress(body)
+            except Exception as e:
+                # each library has its own exceptions
+                raise KbError("Could not decompress a message from the knowledge base: %s" % e)
+
+        try:
+            status, value = self._loads(body)
+        except (ValueError, TypeError) as e:
+            raise KbError("Invalid message from the knowledge base: %s" % e)
+
+        if status == KB_EVENT:
+            return status, tuple(value)
+        if status not in (KB_OK, KB_ERROR):
+            raise KbError("Got an unexpected message status from the knowledge base: %s"%status)
+        return status, value
+
+
+class ResultSet(Sequence):
+    """ A compact, read-only result of a ``find`` query, returned instead of
+    a list with ``KB(result_sets = True)``.
+
+    The values are stored by column (one tuple per variable), and the
+    strings are interned: each resource is stored once, however many rows
+    it appears in.
+
+    A ResultSet reads like the list it replaces (a list of dicts, or a
+    list of values for single-variable queries): it can be iterated,
+    indexed, sliced (as a list), compared to a list, and so on. It is
+    however not a ``list``: it can not be modified, and serializers like
+    ``json.dumps`` reject it. Rows are created on access; :meth:`rows` and
+    :meth:`column` are the cheap ways to go through the results:
+
+    .. code:: python
+
+        res = kb["?agent desires ?action", "?action rdf:type Jump"]
+
+        for agent, action in res.rows():
+            #...
+        jumpers = set(res.column("agent"))
+
+    Use ``list(res)`` to get a (mutable, serializable) list.
+    """
+
+    __slots__ = ("vars", "_columns", "_dicts", "_count")
+
+    def __init__(self, vars, rows = ()):
+        #: the names of the variables (without '?'), in the order of the columns
+        self.vars = tuple(v.lstrip('?') for v in vars)
+        columns = [[] for v in self.vars]
+        # number of rows, kept for the queries without variable (one empty
+        # dict per matching row)
+        self._count = 0
+
+        rows = iter(rows)
+        first = next(rows, _CLOSED)
+        # single-variable queries return bare values rather than dicts
+        self._dicts = isinstance(first, dict) or (first is _CLOSED and len(self.vars) != 1)
+        if first is not _CLOSED:
+            if self._dicts:
+                appends = [(var, column.append) for var, column in zip(self.vars, columns)]
+                for row in itertools.chain((first,), rows):
+                    self._count += 1
+                    for var, append in appends:
+                        append(_intern(row.get(var)))
+            else:
+                self.vars = self.vars[:1]
+                columns = [list(map(_intern, itertools.chain((first,), rows)))]
+                self._count = len(columns[0])
+
+        self._columns = tuple(tuple(column) for column in columns)
+
+    def column(self, var):
+        """ Returns the values of a variable (with or without '?'), as a
+        tuple.
+        """
+        try:
+            return self._columns[self.vars.index(var.lstrip('?'))]
+        except ValueError:
+            raise KeyError(var)
+
+    def rows(self):
+        """ Iterates over the rows, as tuples of values (in the order of
+        :attr:`vars`).
+        """
+        if not self._columns:
+            return itertools.repeat((), self._count)
+        return zip(*self._columns)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if not self._columns:
+            # no variable: only the number of rows is known
+            rows = range(self._count)[index]
+            return [{} for r in rows] if isinstance(index, slice) else {}
+        if isinstance(index, slice):
+            return [self._row(r) for r in zip(*(c[index] for c in self._columns))]
+        return self._row(tuple(c[index] for c in self._columns))
+
+    def __iter__(self):
+        if not self._dicts:
+            return iter(self._columns[0] if self._columns else ())
+        return (dict(zip(self.vars, r)) for r in self.rows())
+
+    def _row(self, values):
+        return dict(zip(self.vars, values)) if self._dicts else values[0]
+
+    def __eq__(self, other):
+        if isinstance(other, (list, ResultSet)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return "<ResultSet of %d rows (%s)>" % (len(self), ", ".join(self.vars))
+
+class StatementArrays(object):
+    """ Statements as NumPy arrays of term ids, returned by
+    :meth:`KB.to_arrays`.
+
+    ``subjects``, ``predicates`` and ``objects`` hold the ids of the terms
+    of each statement; ``terms`` maps ids to terms, and ``ids`` terms to
+    ids.
+    """
+
+    def __init__(self, ids, subjects, predicates, objects):
+        self.ids = ids
+        self.terms = ids.terms
+        self.subjects = subjects
+        self.predicates = predicates
+        self.objects = objects
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def adjacency(self, predicate = None):
+        """ Returns the adjacency matrix of a predicate, as a
+        ``len(terms) x len(terms)`` SciPy sparse matrix (CSR) with a 1 at
+        ``(subject id, object id)`` for each statement. Without
+        ``predicate``, returns a dict with the matrix of every predicate.
+
+        Requires SciPy (``pip install pykb[scipy]``).
+        """
+        try:
+            import numpy
+            from scipy.sparse import csr_matrix
+        except ImportError:
+            raise ImportError("StatementArrays.adjacency requires SciPy (pip install pykb[scipy])")
+
+        shape = (len(self.terms), len(self.terms))
+
+        def matrix(selected):
+            return csr_matrix((numpy.ones(len(selected), numpy.int8),
+                               (self.subjects[selected], self.objects[selected])),
+                              shape = shape)
+
+        if predicate is not None:
+            if predicate not in self.ids:
+                return csr_matrix(shape, dtype = numpy.int8)
+            return matrix(numpy.flatnonzero(self.predicates == self.ids[predicate]))
+
+        # groups the statements by predicate with a single sort
+        order = numpy.argsort(self.predicates, kind = "stable")
+        predicates, starts = numpy.unique(self.predicates[order], return_index = True)
+        bounds = list(starts[1:]) + [len(order)]
+        return dict((self.terms[p], matrix(order[start:end])) \
+                    for p, start, end in zip(predicates, starts, bounds))
+
+class _TermIds(dict):
+    """ Term -> id mapping, giving the next id to unknown terms. """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.terms = []
+
+    def __missing__(self, term):
+        id = self[term] = len(self.terms)
+        self.terms.append(term)
+        return id
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class _ArrayDecoder(object):
+    """ Incrementally decodes the elements of a JSON array, received in
+    several pieces.
+    """
+
+    START, ITEMS, END, RAW = range(4)
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._state = _ArrayDecoder.START
+
+    def feed(self, text):
+        """ Adds a piece of JSON text, and returns the list of the array
+        elements that are now complete.
+        """
+        if self._pos < len(self._text):
+            # the beginning of an element is left from the previous piece
+            text = self._text[self._pos:] + text
+        pos = 0
+
+        elements = []
+        while self._state != _ArrayDecoder.RAW:
+            pos = _whitespace.match(text, pos).end()
+            if pos == len(text):
+                break
+
+            if self._state == _ArrayDecoder.START:
+                if text[pos] != '[':
+                    # not an array: decoded at once, when complete
+                    self._state = _ArrayDecoder.RAW
+                    break
+                self._state = _ArrayDecoder.ITEMS
+                pos += 1
+            elif self._state == _ArrayDecoder.ITEMS:
+                if text[pos] == ']':
+                    self._state = _ArrayDecoder.END
+                    pos += 1
+                elif text[pos] == ',':
+                    pos += 1
+                else:
+                    try:
+                        element, end = _json_decoder.raw_decode(text, pos)
+                    except ValueError:
+                        # incomplete element
+                        break
+                    if not isinstance(element, (str, list, dict)) and \
+                       (end == len(text) or text[end] not in ",] \t\r\n"):
+                        # a number or a literal may continue in the next
+                        # piece (like '-2500.' followed by '0')
+                        break
+                    elements.append(element)
+                    pos = end
+            else:
+                raise KbError("Unexpected data after the end of the response")
+
+        self._text, self._pos = text, pos
+        return elements
+
+    def close(self):
+        """ Returns the remaining elements, once the whole JSON text has been
+        fed.
+        """
+        rest = self._text[self._pos:].strip()
+
+        if self._state == _ArrayDecoder.RAW:
+            value = json.loads(rest)
+            if value is None:
+                return []
+            return value if isinstance(value, list) else [value]
+
+        if self._state == _ArrayDecoder.START and not rest:
+            # empty response
+            return []
+        if self._state != _ArrayDecoder.END or rest:
+            raise KbError("Truncated response from the knowledge base")
+        return []
+
+
+class ResultStream(object):
+    """ Iterator over the elements of a response that is decoded while it is
+    received. Used by :meth:`KB.iter`.
+
+    The elements are handed over to the consumer by pages of ``page_size``
+    elements. At most ``max_pages`` pages are buffered: beyond that, the
+    reception of the response waits for the consumer, unless other requests
+    are waiting behind this response on the connection.
+
+    Call :meth:`close` to give up on the remaining elements.
+    """
+
+    def __init__(self, page_size = 1000, max_pages = 4, row = None):
+        self._page_size = max(1, page_size)
+        self._max_pages = max(1, max_pages)
+        self._row = row
+
+        self._decoder = _ArrayDecoder()
+        # page being filled by the reception side
+        self._page = []
+        # complete pages, waiting for the consumer
+        self._pages = deque()
+        self._current = iter(())
+
+        self._cond = threading.Condition()
+        self._throttled = True
+        self._done = False
+        self._closed = False
+        self._error = None
+
+    #### reception side (see MessageParser) ####
+    def feed(self, text):
+        for element in self._decoder.feed(text):
+            self._page.append(element)
+            if len(self._page) >= self._page_size:
+                self._push_page()
+
+    def _push_page(self):
+        page, self._page = self._page, []
+        with self._cond:
+            while self._throttled and not self._closed and len(self._pages) >= self._max_pages:
+                self._cond.wait()
+            if not self._closed:
+                self._pages.append(page)
+            self._cond.notify_all()
+
+    def release(self):
+        """ Stops throttling the reception of the response: the remaining
+        elements are buffered regardless of the consumer.
+        """
+        with self._cond:
+            self._throttled = False
+            self._cond.notify_all()
+
+    #### future-like interface, used by the clients ####
+    def cancelled(self):
+        return False
+
+    def set_result(self, value):
+        try:
+            if value is not None:
+                # the response was not streamed
+                self._page.extend(value if isinstance(value, list) else [value])
+            else:
+                self._page.extend(self._decoder.close())
+        except KbError as e:
+            self.set_exception(e)
+            return
+
+        self._push_page()
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    def set_exception(self, exception):
+        with self._cond:
+            self._error = exception
+            self._done = True
+            self._cond.notify_all()
+
+    #### consumer side ####
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            element = next(self._current, _CLOSED)
+            if element is not _CLOSED:
+                return self._row(element) if self._row else element
+
+            with self._cond:
+                while not self._pages and not self._done:
+                    self._cond.wait()
+                if self._pages:
+                    self._current = iter(self._pages.popleft())
+                    self._cond.notify_all()
+                elif self._error:
+                    raise self._error
+                else:
+                    raise StopIteration
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._pages.clear()
+            self._cond.notify_all()
+        self._current = iter(())
+
+
+def _consume(stream):
+    """ Iterates over a :class:`ResultStream`, and closes it when the
+    iteration is given up.
+    """
+    try:
+        for element in stream:
+            yield element
+    finally:
+        stream.close()
+
+def _resolve(future, status, value):
+    if future.cancelled():
+        # the caller is not interested in the answer anymore
+        return
+
+    if status == KB_ERROR:
+        future.set_exception(KbError(value))
+    else:
+        future.set_result(value)
+
+def _debug_request(m, args, kwargs):
+    kblogger.debug("Sending <%s(%s,%s)> request to server." % \
+                    (m,
+                     ", ".join([str(a) for a in args]),
+                     ", ".join(str(k)+"="+str(v) for k,v in kwargs.items())))
+
+
+class RemoteKBClient(object):
+    """ Connection to a remote knowledge base.
+
+    Requests are written to the socket by the calling thread. A background
+    thread reads the messages coming from the server: responses resolve the
+    futures of the pending requests, and events are forwarded to the event
+    queue.
+
+    ``connect_timeout`` (in seconds) bounds the time spent establishing the
+    connection (by default, the timeout of the OS).
+    """
+
+    def __init__(self, event_queue, host='localhost', port=DEFAULT_PORT, sock=None, binary = False, compression = False, connect_timeout = None):
+
+        self.host = host
+        self.port = port
+
+        if not sock:
+            try:
+                sock = socket.create_connection((host, port), connect_timeout)
+                sock.settimeout(None)
+            except socket.error as e:
+                raise KbError("Could not connect to the knowledge base on %s:%s " % (host, port) + \
+                              "(%s). Is it started?" % e)
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = sock
+        self._parser = MessageParser(self._stream_for)
+
+        # (method, future) of the requests sent to the server, in the order
+        # they were sent. The server answers the requests in order, so each
+        # response (ie, anything but an event) goes to the oldest pending
+        # request.
+        self._pending = deque()
+        self._send_lock = threading.RLock()
+        self._closed = False
+        # see KB.enable_stats
+        self.metrics = None
+        # codec and compression of the binary protocol, if negotiated (see
+        # negotiate)
+        self.codec = None
+        self.compression = None
+        self._dumps = None
+        self._compressor = self._decompressor = None
+
+        self._events = event_queue
+
+        self._reader = threading.Thread(target=self._read_loop, name="kb-reader")
+        self._reader.daemon = True
+        self._reader.start()
+
+        if binary or compression:
+            self.negotiate(compression)
+
+    def negotiate(self, compression = False):
+        """ Asks the server to switch to the binary protocol: length-prefixed
+        frames (see :class:`FrameParser`), encoded with the first codec of
+        :func:`_available_codecs` the server supports.
+
+        With ``compression``, the messages larger than
+        :data:`COMPRESSION_THRESHOLD` are also compressed, with the first
+        compression of :func:`_available_compressions` the server supports
+        (if any).
+
+        Must be called before any other request. Returns the name of the
+        codec, or None if the server does not support the binary protocol
+        (the text protocol is then kept).
+        """
+        codecs = _available_codecs()
+        compressions = _available_compressions() if compression else {}
+        options = {"framing": ["length"], "codecs": list(codecs)}
+        if compressions:
+            options["compression"] = list(compressions)
+        try:
+            res = self.call_server("negotiate", options)
+        except KbError as e:
+            kblogger.info("The knowledge base does not support the binary protocol (%s)." % e)
+            return None
+
+        if not isinstance(res, dict) or res.get("framing") != "length" or res.get("codec") not in codecs:
+            kblogger.info("The knowledge base does not support the binary protocol " + \
+                          "(answer: %s)." % str(res))
+            return None
+
+        kblogger.debug("Switching to the binary protocol, with %s" % res["codec"])
+        dumps, loads = codecs[res["codec"]]
+
+        decompress = None
+        if res.get("compression") in compressions:
+            kblogger.debug("Compressing large messages with %s" % res["compression"])
+            self._compressor, self._decompressor = compressions[res["compression"]]
+            decompress = self._decompress
+
+        # the server does not send anything until our next request: the
+        # reader is done with the text protocol.
+        with self._send_lock:
+            self._parser = FrameParser(loads, decompress)
+            self._dumps = dumps
+            self.codec = res["codec"]
+            self.compression = res.get("compression") if decompress else None
+        return self.codec
+
+    def _frame(self, body):
+        # returns the frame of a request of the binary protocol
+        if self.compression is None or len(body) < COMPRESSION_THRESHOLD:
+            return FRAME_HEADER.pack(len(body), 0) + body
+
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        compressed = self._compressor(body)
+        if metrics is not None:
+            metrics.compressed(len(body), len(compressed), time.perf_counter() - start)
+
+        if len(compressed) >= len(body):
+            return FRAME_HEADER.pack(len(body), 0) + body
+        return FRAME_HEADER.pack(len(compressed), FRAME_COMPRESSED) + compressed
+
+    def _decompress(self, body):
+        metrics = self.metrics
+        if metrics is None:
+            return self._decompressor(body)
+
+        start = time.perf_counter()
+        data = self._decompressor(body)
+        metrics.decompressed(len(data), len(body), time.perf_counter() - start)
+        return data
+
+    def _read_loop(self):
+        try:
+            while True:
+                data = self._sock.recv(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                if self.metrics is None:
+                    for status, value in self._parser.feed(data):
+                        self._dispatch(status, value)
+                    # do not hold the last response until the next one
+                    value = None
+                else:
+                    self._measured_feed(data)
+        except socket.error as e:
+            if not self._closed:
+                kblogger.error("Connection to the knowledge base lost: %s" % e)
+        except KbError as e:
+            kblogger.error("%s. Closing the connection." % e)
+        finally:
+            self._shutdown()
+
+    def _measured_feed(self, data):
+        metrics = self.metrics
+        metrics.received(len(data))
+
+        messages = self._parser.feed(data)
+        while True:
+            # the parser decodes each message when it is complete
+            start = time.perf_counter()
+            try:
+                status, value = next(messages)
+            except StopIteration:
+                break
+            end = time.perf_counter()
+
+            if status == KB_EVENT:
+                metrics.event()
+            elif self._pending:
+                method, future, timer = self._pending[0]
+                if timer:
+                    metrics.response(method,
+                                     wait = start - timer[1],
+                                     decode = end - start,
+                                     total = end - timer[0],
+                                     size = self._parser.message_size,
+                                     error = status == KB_ERROR)
+            self._dispatch(status, value)
+
+    def _dispatch(self, status, value):
+        if status == KB_EVENT:
+            kblogger.debug("Event received: %s (%s)" % value)
+            self._events.put(value)
+            return
+
+        try:
+            method, future, timer = self._pending.popleft()
+        except IndexError:
+            kblogger.warning("Got a response from the knowledge base that does " + \
+                          "not match any request: %s" % str(value))
+            return
+
+        _resolve(future, status, value)
+
+    def _shutdown(self):
+        with self._send_lock:
+            if self._closed:
+                return
+            self._closed = True
+
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+
+            # the connection is gone: nobody will answer the pending requests
+            while self._pending:
+                method, future, timer = self._pending.popleft()
+                _resolve(future, KB_ERROR, "Connection to the knowledge base closed.")
+
+    def close(self):
+        self._shutdown()
+        if threading.current_thread() is not self._reader:
+            self._reader.join()
+
+    def call_server(self, method, *args, **kwargs):
+        return self.call_server_async(method, *args, **kwargs).result()
+
+    def call_server_async(self, method, *args, **kwargs):
+        """ Sends a request to the server and returns a future holding its
+        response. Does not wait for the response, so that several requests
+        can be in flight on the connection at the same time.
+        """
+        return self._send(Future(), method, args, kwargs)
+
+    def call_server_stream(self, stream, method, *args, **kwargs):
+        """ Sends a request whose response (a list) is decoded while it is
+        received, and handed over to ``stream`` (a :class:`ResultStream`).
+        """
+        return self._send(stream, method, args, kwargs)
+
+    def _stream_for(self):
+        # called by the parser (from the reader thread) when a successful
+        # response starts: is it the response of a streamed request?
+        try:
+            method, future, timer = self._pending[0]
+        except IndexError:
+            return None
+        return future if isinstance(future, ResultStream) else None
+
+    def _send(self, future, method, args, kwargs):
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+
+        dumps = self._dumps
+        if dumps is None:
+            msg = encode(method, *args, **kwargs).encode("utf-8")
+        else:
+            msg = self._frame(dumps([method, args, kwargs]))
+
+        timer = None
+        if metrics is not None:
+            # [start, end of the sending]
+            timer = [start, time.perf_counter()]
+
+        # appending the future and sending the request must be atomic, for
+        # the order of self._pending to match the order on the wire.
+        with self._send_lock:
+            if self._closed:
+                if method == "close":
+                    future.set_result(None)
+                else:
+                    future.set_exception(KbError("Connection to the knowledge base closed."))
+                return future
+
+            # the responses of this request will come after the streamed
+            # responses still pending: these can not wait for their consumer
+            # anymore.
+            for m, f, t in list(self._pending):
+                if isinstance(f, ResultStream):
+                    f.release()
+
+            # the server does not answer 'close' requests
+            if method != "close":
+                self._pending.append((method, future, timer))
+            try:
+                self._sock.sendall(msg)
+            except socket.error as e:
+                kblogger.error("Connection to the knowledge base lost: %s" % e)
+                self._shutdown()
+
+            if timer:
+                sent = time.perf_counter()
+                metrics.request(method, encode = timer[1] - start, send = sent - timer[1], size = len(msg))
+                timer[1] = sent
+
+        if method == "close" and not future.done():
+            future.set_result(None)
+
+        return future
+
+
+class _Replica(object):
+    """ State of a read replica of a :class:`ClusterClient`.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.client = None
+        # moving average of the response time of the replica
+        self.latency = 0.
+        # out of the rotation until then (if dead or slow)
+        self.retry_at = 0.
+        self.connecting = False
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def available(self):
+        return self.client is not None and not self.client._closed and not self.retry_at
+
+    def stats(self):
+        return {"address": "%s:%s" % (self.host, self.port),
+                "available": self.available(),
+                "outstanding": len(self.client._pending) if self.client else 0,
+                "latency": self.latency,
+                "requests": self.requests,
+                "failures": self.failures,
+                "ejections": self.ejections}
+
+
+class ClusterClient(object):
+    """ Connection to a primary knowledge base and its read replicas, used
+    by :class:`ClusterKB`.
+
+    Read-only requests (:data:`CACHED_METHODS`) go to the available replica
+    with the fewest outstanding requests, and all the other requests to the
+    primary. A replica is taken out of the rotation for ``retry_interval``
+    seconds when its connection is lost (the request is then sent to
+    another replica, or to the primary) or when its average response time
+    exceeds ``max_latency`` seconds. Without replica available, reads go to
+    the primary.
+
+    With ``read_your_writes`` (in seconds), reads go to the primary while
+    writes are in flight and for ``read_your_writes`` seconds after them,
+    so that they see these writes even if the replicas lag behind.
+
+    A replica that does not answer a read within ``read_timeout`` seconds
+    is taken out of the rotation as well: its connection is closed, and its
+    outstanding reads are sent to another replica, or to the primary.
+
+    The replicas are connected in the background (with a timeout of
+    ``connect_timeout`` seconds): they join the rotation once connected.
+    """
+
+    # weight of the last response time in the average latency of a replica
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, event_queue, primary, replicas, binary = False, compression = False,
+                 read_your_writes = None, max_latency = 0.5, retry_interval = 5., connect_timeout = 2.,
+                 read_timeout = 5.):
+
+        self._events = event_queue
+        self._binary = binary
+        self._compression = compression
+        self.read_your_writes = read_your_writes
+        self.max_latency = max_latency
+        self.retry_interval = retry_interval
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self.primary = RemoteKBClient(event_queue, primary[0], primary[1], None, binary, compression)
+        self.metrics = None
+
+        self._lock = threading.Lock()
+        self._writes = 0 # writes in flight
+        self._last_write = 0.
+        # reads sent to a replica: future -> (deadline, replica, client)
+        self._reads = {}
+        self._closing = threading.Event()
+
+        self.replicas = [_Replica(host, port) for host, port in replicas]
+        with self._lock:
+            for replica in self.replicas:
+                self._connect_replica(replica)
+
+        if self.replicas and read_timeout:
+            watchdog = threading.Thread(target = self._watch, name = "kb-replica-watchdog")
+            watchdog.daemon = True
+            watchdog.start()
+
+    #### client interface, see RemoteKBClient ####
+    @property
+    def metrics(self):
+        return self.primary.metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self.primary.metrics = metrics
+        for replica in getattr(self, "replicas", []):
+            if replica.client:
+                replica.client.metrics = metrics
+
+    @property
+    def codec(self):
+        return self.primary.codec
+
+    @property
+    def compression(self):
+        return self.primary.compression
+
+    @property
+    def _pending(self):
+        return self.primary._pending
+
+    def call_server(self, method, *args, **kwargs):
+        return self.call_server_async(method, *args, **kwargs).result()
+
+    def call_server_async(self, method, *args, **kwargs):
+        if method in CACHED_METHODS:
+            return self._read(Future(), method, args, kwargs, [])
+
+        if method not in WRITE_METHODS or not self.read_your_writes:
+            return self.primary.call_server_async(method, *args, **kwargs)
+
+        with self._lock:
+            self._writes += 1
+        future = self.primary.call_server_async(method, *args, **kwargs)
+        future.add_done_callback(self._write_done)
+        return future
+
+    def call_server_stream(self, stream, method, *args, **kwargs):
+        replica = self._pick([]) if method in CACHED_METHODS else None
+        client = replica.client if replica else self.primary
+        return client.call_server_stream(stream, method, *args, **kwargs)
+
+    def close(self):
+        with self._lock:
+            # the replicas still connecting close their connection themselves
+            self._closing.set()
+            clients = [replica.client for replica in self.replicas if replica.client]
+        for client in clients:
+            client.call_server_async("close")
+            client.close()
+        self.primary.close()
+
+    def stats(self):
+        """ Returns the state of each replica: whether it is in the rotation,
+        its outstanding requests, average response time (in seconds), and
+        the number of requests, failures and ejections.
+        """
+        with self._lock:
+            return [replica.stats() for replica in self.replicas]
+
+    #### routing ####
+    def _write_done(self, future):
+        with self._lock:
+            self._writes -= 1
+            self._last_write = time.time()
+
+    def _pick(self, excluded):
+        """ Returns the replica a read should go to, or None for the
+        primary.
+        """
+        now = time.time()
+        with self._lock:
+            if self.read_your_writes and \
+               (self._writes or now - self._last_write < self.read_your_writes):
+                return None
+
+            best = None
+            for replica in self.replicas:
+                if not replica.retry_at and not replica.connecting and \
+                   (replica.client is None or replica.client._closed):
+                    self._eject(replica, "connection lost")
+                if replica.retry_at and now >= replica.retry_at:
+                    self._readmit(replica)
+                if not replica.available() or replica in excluded:
+                    continue
+                if best is None or len(replica.client._pending) < len(best.client._pending):
+                    best = replica
+            if best:
+                best.requests += 1
+            return best
+
+    def _read(self, future, method, args, kwargs, tried):
+        replica = self._pick(tried)
+        # the client of the replica may be replaced by a new one (see
+        # _reconnect) before the response
+        client = self.primary if replica is None else replica.client
+        start = time.time()
+        inner = client.call_server_async(method, *args, **kwargs)
+        if replica is not None and self.read_timeout:
+            with self._lock:
+                self._reads[inner] = (start + self.read_timeout, replica, client)
+
+        def done(inner):
+            if replica is not None:
+                with self._lock:
+                    self._reads.pop(inner, None)
+                if client._closed:
+                    # the replica is dead: try another one
+                    with self._lock:
+                        replica.failures += 1
+                        self._eject(replica, "connection lost")
+                    self._read(future, method, args, kwargs, tried + [replica])
+                    return
+                self._record(replica, time.time() - start)
+
+            if inner.exception():
+                future.set_exception(inner.exception())
+            else:
+                future.set_result(inner.result())
+
+        inner.add_done_callback(done)
+        return future
+
+    def _watch(self):
+        # closes the connection of the replicas that do not answer in time:
+        # their outstanding reads are then retried elsewhere (see _read)
+        while not self._closing.wait(self.read_timeout / 4.):
+            now = time.time()
+            with self._lock:
+                late = set((replica, client) for deadline, replica, client in self._reads.values() \
+                           if now >= deadline and not client._closed)
+                for replica, client in late:
+                    self._eject(replica, "no response for %ss" % self.read_timeout)
+            for replica, client in late:
+                client._shutdown()
+
+    def _record(self, replica, duration):
+        with self._lock:
+            replica.latency += (duration - replica.latency) * self.LATENCY_SMOOTHING
+            if replica.latency > self.max_latency:
+                self._eject(replica, "average response time of %.3fs" % replica.latency)
+
+    def _eject(self, replica, reason):
+        # called with the lock held
+        if replica.retry_at:
+            return
+        replica.retry_at = time.time() + self.retry_interval
+        replica.ejections += 1
+        kblogger.warning("Replica %s:%s out of the rotation for %ss (%s)." % \
+                         (replica.host, replica.port, self.retry_interval, reason))
+
+    def _readmit(self, replica):
+        # called with the lock held
+        if replica.client is not None and not replica.client._closed:
+            kblogger.info("Replica %s:%s back in the rotation." % (replica.host, replica.port))
+            replica.retry_at = 0.
+            replica.latency = 0.
+        elif not replica.connecting:
+            replica.retry_at = time.time() + self.retry_interval
+            self._connect_replica(replica)
+
+    def _connect_replica(self, replica):
+        # called with the lock held
+        if self._closing.is_set():
+            return
+        replica.connecting = True
+        reconnect = threading.Thread(target = self._reconnect, args = (replica,),
+                                     name = "kb-replica-%s:%s" % (replica.host, replica.port))
+        reconnect.daemon = True
+        reconnect.start()
+
+    def _reconnect(self, replica):
+        try:
+            client = RemoteKBClient(self._events, replica.host, replica.port, None,
+                                    self._binary, self._compression, self.connect_timeout)
+            client.metrics = self.primary.metrics
+        except KbError as e:
+            kblogger.warning("Could not connect to the replica %s:%s: %s" % (replica.host, replica.port, e))
+            with self._lock:
+                replica.connecting = False
+                replica.retry_at = time.time() + self.retry_interval
+            return
+
+        with self._lock:
+            replica.connecting = False
+            closing = self._closing.is_set()
+            if not closing:
+                replica.client = client
+                replica.retry_at = 0.
+                replica.latency = 0.
+        if closing:
+            client.close()
+
+
+class ClusterKB(KB):
+    """ A :class:`KB` backed by a primary knowledge base, and any number of
+    read replicas (a list of ``(host, port)``).
+
+    ``find``, ``exist`` and ``lookup`` requests (and thus ``kb[...]``,
+    ``... in kb`` and :meth:`KB.iter`) are spread across the replicas, the
+    other requests (``+=``, ``-=``, subscriptions...) go to the primary.
+    See :class:`ClusterClient` for the routing, and the ``read_your_writes``,
+    ``max_latency``, ``retry_interval``, ``connect_timeout`` and
+    ``read_timeout`` options.
+
+    .. code:: python
+
+        kb = ClusterKB(("kb-main", 6969), [("kb-replica1", 6969), ("kb-replica2", 6969)],
+                       read_your_writes = 0.5)
+        kb += ["alfred rdf:type Human"]
+        if "alfred rdf:type Human" in kb: # goes to the primary, for 0.5s
+            #...
+        print(kb.replica_stats())
+
+    The other options are the ones of :class:`KB`.
+    """
+
+    def __init__(self, primary = ('localhost', DEFAULT_PORT), replicas = (), read_your_writes = None,
+                 max_latency = 0.5, retry_interval = 5., connect_timeout = 2., read_timeout = 5., **kwargs):
+        self._cluster = (replicas, read_your_writes, max_latency, retry_interval, connect_timeout, read_timeout)
+        KB.__init__(self, primary[0], primary[1], **kwargs)
+
+    def _connect(self, host, port, sock, binary, compression):
+        replicas, read_your_writes, max_latency, retry_interval, connect_timeout, read_timeout = self._cluster
+        return ClusterClient(self._internal_events, (host, port), replicas, binary, compression,
+                             read_your_writes, max_latency, retry_interval, connect_timeout, read_timeout)
+
+    def replica_stats(self):
+        """ See :meth:`ClusterClient.stats`.
+        """
+        return self._client.stats()
+
+    def stats(self):
+        stats = KB.stats(self)
+        stats["replicas"] = self.replica_stats()
+        return stats
+
+
+class KBPool(object):
+    """ A thread-safe pool of at most ``size`` connections to a knowledge
+    base, for applications serving many concurrent requests.
+
+    Connections (:class:`KB` objects, created on demand) are checked out for
+    a single call, or for a ``with`` block:
+
+    .. code:: python
+
+        pool = KBPool("kb-server", size = 16)
+
+        humans = pool["?h rdf:type Human"]
+        pool += ["alfred rdf:type Human"]
+        pool.about("alfred") # any method of the server
+        pool.exist_many(patterns)
+
+        with pool.connection() as kb:
+            with kb.batch():
+                #...
+
+    The other methods of :class:`KB` (like ``batch``, ``iter`` or
+    ``enable_cache``) keep a state on their connection: they are only
+    available on a checked out connection.
+
+    When all the connections are in use, callers wait for one to be
+    returned, for at most ``timeout`` seconds (forever if None), then get a
+    :class:`KbError`.
+
+    Idle connections are checked every ``health_check_interval`` seconds
+    (with a ``methods`` request), and closed if they do not answer within
+    ``health_check_timeout`` seconds. Connections found closed when
+    returned to the pool are dropped as well.
+
+    Subscriptions go through one dedicated connection, shared by the whole
+    pool: use :meth:`subscribe` and :attr:`events` rather than subscribing
+    on a checked out connection.
+
+    Other options (like ``binary``) are passed to each :class:`KB`.
+    """
+
+    def __init__(self, host = 'localhost', port = DEFAULT_PORT, size = 8, timeout = None,
+                 health_check_interval = 30., health_check_timeout = 5., **kwargs):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        # all the connections share the method table of the first one
+        self._options = dict(kwargs, cache_methods = True)
+
+        self._cond = threading.Condition()
+        # idle connections, with the time they were returned, most recent last
+        self._idle = []
+        # number of open connections, idle or checked out
+        self._count = 0
+        self._closed = False
+
+        self._events_kb = None
+        self._events_lock = threading.Lock()
+
+        self._stop_checks = threading.Event()
+        if health_check_interval:
+            checker = threading.Thread(target = self._check_health, name = "kb-pool-health")
+            checker.daemon = True
+            checker.start()
+
+    #### checkout ####
+    @contextlib.contextmanager
+    def connection(self):
+        """ Checks out a connection for the duration of a ``with`` block.
+        """
+        kb = self._checkout()
+        try:
+            yield kb
+        finally:
+            self._checkin(kb)
+
+    def _checkout(self):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise KbError("The pool of connections is closed.")
+                if self._idle:
+                    return self._idle.pop()[0]
+                if self._count < self.size:
+                    self._count += 1
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise KbError("No connection to the knowledge base available after %ss." % self.timeout)
+                self._cond.wait(remaining)
+
+        try:
+            return KB(self.host, self.port, **self._options)
+        except Exception:
+            self._drop(None)
+            raise
+
+    def _checkin(self, kb):
+        with self._cond:
+            if not self._closed and not kb._client._closed:
+                self._idle.append((kb, time.time()))
+                self._cond.notify()
+                return
+        self._drop(kb)
+
+    def _drop(self, kb):
+        if kb is not None:
+            kb.close()
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+
+    def _check_health(self):
+        while not self._stop_checks.wait(self.health_check_interval):
+            now = time.time()
+            with self._cond:
+                stale = [c for c in self._idle if now - c[1] >= self.health_check_interval]
+                for c in stale:
+                    self._idle.remove(c)
+
+            for kb, last_used in stale:
+                try:
+                    kb.submit("methods").result(self.health_check_timeout)
+                except Exception as e:
+                    kblogger.warning("Closing an unhealthy connection of the pool: %s" % (e or "timeout"))
+                    self._drop(kb)
+                else:
+                    self._checkin(kb)
+
+    #### per-call checkout ####
+    # KB methods that are stateless, and thus usable on any connection
+    POOLED_METHODS = ("find_many", "exist_many", "lookup_many")
+    # server methods that must not be called on a pooled connection
+    UNPOOLED_PROXIES = ("server_subscribe", "server_close")
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+
+        if name not in self.POOLED_METHODS:
+            if name in self.UNPOOLED_PROXIES or name not in self._server_methods():
+                raise AttributeError("'%s' object has no attribute '%s': the methods of KB that "
+                                     "keep a state (like batch or iter) must be called on a "
+                                     "connection, with 'with pool.connection() as kb:'" % \
+                                     (type(self).__name__, name))
+
+        def pooled(*args, **kwargs):
+            with self.connection() as kb:
+                return getattr(kb, name)(*args, **kwargs)
+        pooled.__name__ = name
+        return pooled
+
+    def _server_methods(self):
+        # the method table of the server (shared by the connections, see
+        # KB(cache_methods = True)) is known once a connection exists
+        methods = _method_tables.get((self.host, self.port))
+        if methods is None:
+            with self.connection():
+                methods = _method_tables.get((self.host, self.port), [])
+        return _proxies(methods)
+
+    def __getitem__(self, *args):
+        with self.connection() as kb:
+            return kb.__getitem__(*args)
+
+    def __contains__(self, pattern):
+        with self.connection() as kb:
+            return pattern in kb
+
+    def __iadd__(self, stmts):
+        with self.connection() as kb:
+            kb += stmts
+        return self
+
+    def __isub__(self, stmts):
+        with self.connection() as kb:
+            kb -= stmts
+        return self
+
+    #### events ####
+    def _subscriptions(self):
+        with self._events_lock:
+            if self._events_kb is None:
+                self._events_kb = KB(self.host, self.port, **self._options)
+            return self._events_kb
+
+    def subscribe(self, pattern, callback = None, var = None, type = 'NEW_INSTANCE', trigger = 'ON_TRUE', models = None):
+        """ Subscribes to an event, through the connection dedicated to the
+        events. See :meth:`KB.subscribe`.
+        """
+        return self._subscriptions().subscribe(pattern, callback, var, type, trigger, models)
+
+    def unsubscribe(self, event_id, callback = None):
+        """ Cancels a subscription made with :meth:`subscribe`. See
+        :meth:`KB.unsubscribe`.
+        """
+        return self._subscriptions().unsubscribe(event_id, callback)
+
+    @property
+    def events(self):
+        """ The events without callback, see :meth:`KB.subscribe`.
+        """
+        return self._subscriptions().events
+
+    #### management ####
+    def stats(self):
+        with self._cond:
+            return {"size": self.size,
+                    "open": self._count,
+                    "idle": len(self._idle)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """ Closes the idle connections, and the others as soon as they are
+        returned.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        self._stop_checks.set()
+
+        for kb, last_used in idle:
+            self._drop(kb)
+        with self._events_lock:
+            if self._events_kb:
+                self._events_kb.close()
+
+
+# the asyncio flavour of the API imports asyncio where needed only: it is
+# slow to import, and not needed by the other users of the module.
+
+class AsyncKBClient(object):
+    """ asyncio counterpart of :class:`RemoteKBClient`, used by :class:`AsyncKB`.
+
+    Must be created with :meth:`AsyncKBClient.connect`.
+    """
+
+    def __init__(self, reader, writer, on_event):
+        import asyncio
+        self._reader = reader
+        self._writer = writer
+        self._parser = MessageParser()
+
+        # see RemoteKBClient._pending
+        self._pending = deque()
+        self._closed = False
+
+        self._on_event = on_event
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    @classmethod
+    async def connect(cls, on_event, host='localhost', port=DEFAULT_PORT, sock=None):
+        import asyncio
+        try:
+            if sock:
+                reader, writer = await asyncio.open_connection(sock=sock)
+            else:
+                reader, writer = await asyncio.open_connection(host, port)
+        except OSError as e:
+            raise KbError("Could not connect to the knowledge base on %s:%s " % (host, port) + \
+                          "(%s). Is it started?" % e)
+
+        sock = writer.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return cls(reader, writer, on_event)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self._reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                for status, value in self._parser.feed(data):
+                    self._dispatch(status, value)
+        except OSError as e:
+            if not self._closed:
+                kblogger.error("Connection to the knowledge base lost: %s" % e)
+        except KbError as e:
+            kblogger.error("%s. Closing the connection." % e)
+        finally:
+            self._shutdown()
+
+    def _dispatch(self, status, value):
+        if status == KB_EVENT:
+            kblogger.debug("Event received: %s (%s)" % value)
+            self._on_event(value)
+            return
+
+        try:
+            method, future = self._pending.popleft()
+        except IndexError:
+            kblogger.warning("Got a response from the knowledge base that does " + \
+                          "not match any request: %s" % str(value))
+            return
+
+        _resolve(future, status, value)
+
+    def _shutdown(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        self._writer.close()
+
+        while self._pending:
+            method, future = self._pending.popleft()
+            _resolve(future, KB_ERROR, "Connection to the knowledge base closed.")
+
+    async def close(self):
+        import asyncio
+        self._shutdown()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+        if asyncio.current_task() is not self._read_task:
+            await self._read_task
+
+    def call_server_async(self, method, *args, **kwargs):
+        """ Sends a request to the server and returns an asyncio future
+        holding its response.
+        """
+        import asyncio
+        future = asyncio.get_event_loop().create_future()
+
+        if self._closed:
+            if method == "close":
+                future.set_result(None)
+            else:
+                future.set_exception(KbError("Connection to the knowledge base closed."))
+            return future
+
+        self._writer.write(encode(method, *args, **kwargs).encode("utf-8"))
+
+        # the server does not answer 'close' requests
+        if method == "close":
+            future.set_result(None)
+        else:
+            self._pending.append((method, future))
+
+        return future
+
+    async def call_server(self, method, *args, **kwargs):
+        future = self.call_server_async(method, *args, **kwargs)
+        try:
+            await self._writer.drain()
+        except OSError:
+            # the read loop takes care of failing the pending requests
+            pass
+        return await future
+
+
+class AsyncSubscription(object):
+    """ An event subscription, as returned by :meth:`AsyncKB.subscribe`.
+
+    If no callback was given when subscribing, the subscription is an
+    asynchronous iterator over the successive values of the event:
+
+    .. code:: python
+
+        sub = await kb.subscribe("?o isIn room")
+        print("Subscribed to event %s" % sub.id)
+        async for objects in sub:
+            print("New objects in the room: %s" % objects)
+
+    """
+
+    def __init__(self, event_id, callback = None):
+        import asyncio
+        self.id = event_id
+        self.callback = callback
+        self._values = asyncio.Queue()
+
+    def _put(self, value):
+        import asyncio
+        if not self.callback:
+            self._values.put_nowait(value)
+            return
+
+        kblogger.debug("Executing callback %s" % self.callback.__name__)
+        try:
+            res = self.callback(value)
+            if asyncio.iscoroutine(res):
+                asyncio.ensure_future(res)
+        except Exception as e:
+            kblogger.error("Exception in the callback %s: %s" % (self.callback.__name__, e))
+
+    def _close(self):
+        self._values.put_nowait(_CLOSED)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        value = await self._values.get()
+        if value is _CLOSED:
+            # let other iterators know as well
+            self._values.put_nowait(_CLOSED)
+            raise StopAsyncIteration
+        return value
+
+
+class AsyncKB(object):
+    """ An asyncio flavour of :class:`KB`.
+
+    Every method declared by the server is available as a coroutine, and many
+    requests can run concurrently on a single connection, without any
+    additional thread.
+
+    .. code:: python
+
+        import kb
+
+        async def main():
+            async with kb.AsyncKB() as akb:
+
+                await akb.add(["alfred rdf:type Human", "alfred likes icecream"])
+
+                if await akb.contains("alfred likes *"):
+                    print("Alfred likes something!")
+
+                humans = await akb["?human rdf:type Human"]
+
+                sub = await akb.subscribe("?o isIn room")
+                async for objects in sub:
+                    print("New objects in the room: %s" % objects)
+
+    ``await kb.AsyncKB()`` connects as well, without the context manager.
+    """
+
+    def __init__(self, host='localhost', port=DEFAULT_PORT, sock=None):
+        if not host or not port:
+            raise KbError("No host and/or port specified to connect to the knowledge base.")
+
+        self.host = host
+        self.port = port
+        self._sock = sock
+        self._client = None
+
+        # events that do not belong to one of our subscriptions
+        self.events = None
+
+        self._subscriptions = {}
+        # number of subscriptions waiting for their event id, and events that
+        # arrived in the meantime (they may belong to these subscriptions)
+        self._subscribing = 0
+        self._early_events = []
+
+    def __await__(self):
+        return self.connect().__await__()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def connect(self):
+        import asyncio
+        if self._client:
+            return self
+
+        self.events = asyncio.Queue()
+        self._client = await AsyncKBClient.connect(self._on_event, self.host, self.port, self._sock)
+
+        #add all the methods the server declares
+        methods = await self._client.call_server("methods")
+        if not methods:
+            await self._client.close()
+            raise KbError("Could not connect to the knowledge base. Is it started?")
+        for m in methods:
+            self.add_method(m.split("(")[0])
+
+        return self
+
+    def add_method(self, m):
+        m = str(m)
+        async def innermethod(*args, **kwargs):
+            _debug_request(m, args, kwargs)
+            return await self._client.call_server(m, *args, **kwargs)
+
+        innermethod.__doc__ = "This coroutine is a proxy for the knowledge server %s method." % m
+        #special cases for the server's methods we want to override
+        innermethod.__name__ = _ASYNC_PROXY_NAMES.get(m, m)
+        setattr(self,innermethod.__name__,innermethod)
+
+    async def close(self):
+        if not self._client:
+            return
+
+        try:
+            await self.server_close()
+        except AttributeError:
+            pass
+
+        await self._client.close()
+        self._client = None
+
+        for subscription in self._subscriptions.values():
+            subscription._close()
+
+    async def subscribe(self, pattern, callback = None, var = None, type = 'NEW_INSTANCE', trigger = 'ON_TRUE', models = None):
+        """ Subscribes to an event. Same as :meth:`KB.subscribe`, except that
+        an :class:`AsyncSubscription` is returned.
+
+        The callback, if any, is invoked from the event loop. It can be a
+        coroutine function. Without callback, iterate over the subscription
+        to get the events.
+        """
+        pattern, var = _subscription(pattern, var, type)
+
+        self._subscribing += 1
+        try:
+            event_id = await self.server_subscribe(type, trigger, var, pattern, models)
+        finally:
+            self._subscribing -= 1
+        kblogger.debug("New event successfully registered with ID " + event_id)
+
+        subscription = AsyncSubscription(event_id, callback)
+        self._subscriptions[event_id] = subscription
+
+        early_events, self._early_events = self._early_events, []
+        for event in early_events:
+            self._on_event(event)
+
+        return subscription
+
+    def _on_event(self, event):
+        event_id, value = event
+
+        if event_id in self._subscriptions:
+            self._subscriptions[event_id]._put(value)
+        elif self._subscribing:
+            # the event may come from a subscription whose id is not yet known
+            self._early_events.append(event)
+        else:
+            self.events.put_nowait(event)
+
+    def __getitem__(self, args):
+        """ Same as :meth:`KB.__getitem__`, but returns an awaitable:
+
+        .. code:: python
+
+            agents = await kb["* rdf:type Agent"]
+
+        """
+        return self._request(*_getitem_request(args))
+
+    async def contains(self, pattern):
+        """ Same as ``pattern in kb`` with a :class:`KB`.
+        """
+        method, args = _contains_request(pattern)
+        return bool(await getattr(self, method)(*args))
+
+    async def _request(self, method, args, row):
+        res = await getattr(self, method)(*args)
+        return [row(r) for r in res] if row else res
+
+    async def add(self, stmts):
+        """ Same as ``kb += stmts`` with a :class:`KB`.
+        """
+        await self.update(_as_list(stmts))
+
+    async def remove(self, stmts):
+        """ Same as ``kb -= stmts`` with a :class:`KB`.
+        """
+        await self.retract(_as_list(stmts))
 
 
 if __name__ == '__main__':
@@ -1,6 +1,9 @@
  # -*- coding: utf-8 -*-
 
-from distutils.core import setup
+try:
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
 
 setup(name='pykb',
       version='1.5',
@@ -8,10 +11,18 @@ setup(name='pykb',
       description='Python API to access a KB-API conformant knowledge base',
       classifiers=[
         'License :: OSI Approved :: BSD License',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
       ],
       url='https://github.com/severin-lemaignan/pykb',
       author='Séverin Lemaignan',
       author_email='severin.lemaignan@epfl.ch',
       py_modules=['kb'],
+      # optional codecs for the binary protocol (see KB(binary = True)),
+      # and the array export (see KB.to_arrays)
+      extras_require={
+        'msgpack': ['msgpack'],
+        'cbor': ['cbor2'],
+        'numpy': ['numpy'],
+        'scipy': ['numpy', 'scipy'],
+      },
       )
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+""" Fixtures of the pykb tests: the tests run against the stand-in server of
+``benchmarks/kbserver.py``, started in-process on a free port.
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import kb
+from kbserver import KBServer
+
+
+@pytest.fixture
+def server():
+    server = KBServer().start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def text_server():
+    server = KBServer(binary = False).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def minimalkb(monkeypatch):
+    """ Makes the stand-in of ``tests/minimalkb_standin.py`` the MinimalKB
+    of the embedded clients.
+    """
+    import types
+    import minimalkb_standin
+    package = types.ModuleType("minimalkb")
+    package.kb = minimalkb_standin
+    monkeypatch.setitem(sys.modules, "minimalkb", package)
+    monkeypatch.setitem(sys.modules, "minimalkb.kb", minimalkb_standin)
+    return minimalkb_standin
+
+@pytest.fixture
+def client(server):
+    with kb.KB(port = server.port) as k:
+        yield k
+
+
+def wait_for(condition, timeout = 2.):
+    """ Polls ``condition`` until it is true, for at most ``timeout``
+    seconds. Returns its last value.
+    """
+    import time
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+""" Stand-in of ``minimalkb.kb.MinimalKB``, for the tests of the embedded
+client: it reproduces the request processing of MinimalKB (requests queued
+by ``submitrequest`` and executed by ``process``, or executed right away by
+``execute``; answers and events queued per client, and sent by
+``process``), over the statements of the stand-in server.
+"""
+
+import threading
+from queue import Queue, Empty
+
+from kbserver import StandInKB
+
+
+class Event(object):
+    """ The part of MinimalKB's events sent to the clients. """
+
+    def __init__(self, id, content):
+        self.id = id
+        self.content = content
+
+
+class MinimalKB(object):
+
+    def __init__(self, filenames = None):
+        self.store = StandInKB()
+        self.incomingrequests = Queue()
+        self.requestresults = {}
+        self.eventsubscriptions = {}
+        # threads that executed requests
+        self.threads = set()
+
+    #### KB-API methods ####
+    def methods(self):
+        return self.store.methods(self)
+
+    def find(self, *args, **kwargs):
+        return self.store.find(self, *args, **kwargs)
+
+    def exist(self, *args, **kwargs):
+        return self.store.exist(self, *args, **kwargs)
+
+    def lookup(self, *args, **kwargs):
+        return self.store.lookup(self, *args, **kwargs)
+
+    def about(self, *args, **kwargs):
+        return self.store.about(self, *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        return self.store.update(self, *args, **kwargs)
+
+    def retract(self, *args, **kwargs):
+        return self.store.retract(self, *args, **kwargs)
+
+    def subscribe(self, *args, **kwargs):
+        return self.store.subscribe(self, *args, **kwargs)
+
+    def send_message(self, status, value):
+        # events fired by the store: queued for their subscribers, like
+        # MinimalKB.onupdate does
+        evtid, content = value
+        for client in self.eventsubscriptions.get(evtid, []):
+            self.requestresults.setdefault(client, Queue()).put(("event", Event(evtid, content)))
+
+    #### request processing ####
+    def execute(self, client, name, *args, **kwargs):
+        self.threads.add(threading.current_thread().name)
+        if name == "close":
+            return
+
+        f = getattr(self, name)
+        try:
+            res = f(*args, **kwargs)
+            if name == "subscribe":
+                self.eventsubscriptions.setdefault(res, []).append(client)
+            msg = ("ok", res)
+        except Exception as e:
+            msg = ("error", e)
+
+        self.requestresults.setdefault(client, Queue()).put(msg)
+
+    def submitrequest(self, client, name, *args, **kwargs):
+        self.incomingrequests.put((client, name, args, kwargs))
+
+    def process(self):
+        try:
+            client, name, args, kwargs = self.incomingrequests.get(True, 0.05)
+            self.execute(client, name, *args, **kwargs)
+        except Empty:
+            pass
+
+        for client, pendingmsg in list(self.requestresults.items()):
+            while not pendingmsg.empty():
+                client.sendmsg(pendingmsg.get())
+
+    def stop_services(self):
+        pass
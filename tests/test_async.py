@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+""" The asyncio client. """
+
+import asyncio
+
+import kb
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+
+def test_requests(server):
+    async def main():
+        async with kb.AsyncKB(port = server.port) as akb:
+            await akb.add(["alfred rdf:type Human", "alfred likes icecream"])
+            assert await akb.contains("alfred likes *")
+            assert await akb["?h rdf:type Human"] == ["alfred"]
+            assert await akb["?a likes ?b", "?a rdf:type Human"] == [{"a": "alfred", "b": "icecream"}]
+
+            await akb.remove("alfred likes icecream")
+            assert not await akb.contains("alfred likes *")
+
+            results = await asyncio.gather(*(akb.contains("alfred") for i in range(20)))
+            assert results == [True] * 20
+    run(main())
+
+
+def test_add_is_not_hidden_by_the_server_method(server):
+    methods, added = server.kb.methods, []
+    server.kb.methods = lambda connection: methods(connection) + ["add(stmts, models)"]
+    server.kb.add = lambda connection, stmts, models = None: added.append(stmts)
+
+    async def main():
+        async with kb.AsyncKB(port = server.port) as akb:
+            await akb.add("alfred rdf:type Human")
+            assert await akb["?h rdf:type Human"] == ["alfred"]
+            await akb.server_add(["bob rdf:type Human"])
+    run(main())
+    assert added == [["bob rdf:type Human"]]
+
+
+def test_subscriptions(server):
+    async def main():
+        async with kb.AsyncKB(port = server.port) as akb:
+            received = asyncio.Queue()
+            await akb.subscribe("?o isIn room", callback = received.put)
+            sub = await akb.subscribe("?o isOn table")
+
+            await akb.add(["cup isIn room", "plate isOn table"])
+            assert await received.get() == ["cup"]
+            async for objects in sub:
+                assert objects == ["plate"]
+                break
+    run(main())
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+""" Connection pools, read replicas and mirrors. """
+
+import threading
+
+import pytest
+
+import kb
+from kbserver import KBServer
+
+from conftest import wait_for
+
+
+def test_pool(server):
+    with kb.KBPool(port = server.port, size = 2, timeout = 1) as pool:
+        pool += ["alfred rdf:type Human"]
+        assert pool["?h rdf:type Human"] == ["alfred"]
+        assert "alfred rdf:type Human" in pool
+        assert pool.about("alfred") == [["alfred", "rdf:type", "Human"]]
+        assert pool.exist_many(["alfred rdf:type *"]) == [True]
+
+        errors = []
+        def worker():
+            try:
+                for i in range(20):
+                    assert pool.exist(["alfred rdf:type Human"])
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target = worker) for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors
+        assert pool.stats()["open"] <= 2
+
+        with pool.connection() as k:
+            with k.batch():
+                k += ["cup isIn kitchen"]
+        assert "cup isIn kitchen" in pool
+
+
+def test_pool_does_not_forward_stateful_methods(server):
+    with kb.KBPool(port = server.port) as pool:
+        for name in ("batch", "iter", "enable_cache", "enable_write_behind", "server_subscribe"):
+            with pytest.raises(AttributeError):
+                getattr(pool, name)
+
+
+def test_pool_timeout(server):
+    with kb.KBPool(port = server.port, size = 1, timeout = 0.1) as pool:
+        with pool.connection():
+            with pytest.raises(kb.KbError):
+                pool.exist(["a b c"])
+
+
+def test_pool_events(server):
+    received = []
+    with kb.KBPool(port = server.port) as pool:
+        pool.subscribe("?o isIn kitchen", received.append)
+        pool += ["cup isIn kitchen"]
+        assert wait_for(lambda: received == [["cup"]])
+
+
+def test_cluster_reads_go_to_replicas(server):
+    replica = KBServer().start()
+    try:
+        with kb.ClusterKB(("localhost", server.port), [("localhost", replica.port)]) as k:
+            k += ["a b c"]
+            # the stand-in replica does not replicate: reads see its own state
+            assert wait_for(lambda: k.replica_stats()[0]["available"])
+            assert "a b c" not in k
+            replica.kb.stmts |= server.kb.stmts
+            assert "a b c" in k
+    finally:
+        replica.stop()
+
+
+def test_cluster_with_unreachable_replica(server):
+    with kb.ClusterKB(("localhost", server.port), [("localhost", 1)], connect_timeout = 0.5) as k:
+        k += ["a b c"]
+        # reads fall back to the primary
+        assert "a b c" in k
+
+
+def test_cluster_ejects_unresponsive_replica(server):
+    replica = KBServer().start()
+    hang = threading.Event()
+    replica.kb.exist = lambda connection, patterns, models = None: hang.wait()
+    try:
+        with kb.ClusterKB(("localhost", server.port), [("localhost", replica.port)], read_timeout = 0.2) as k:
+            k += ["a b c"]
+            assert wait_for(lambda: k.replica_stats()[0]["available"])
+            # answered by the primary once the replica is out of the rotation
+            assert "a b c" in k
+            stats = k.replica_stats()[0]
+            assert not stats["available"]
+            assert stats["ejections"] == 1
+            assert stats["failures"] == 1
+    finally:
+        hang.set()
+        replica.stop()
+
+
+def test_cluster_close_stops_replica_connections(server):
+    replica = KBServer().start()
+    try:
+        k = kb.ClusterKB(("localhost", server.port), [("localhost", replica.port)])
+        k.close()
+        assert wait_for(lambda: not any(t.name.startswith("kb-replica-localhost") for t in threading.enumerate()))
+        client = k._client.replicas[0].client
+        assert client is None or client._closed
+    finally:
+        replica.stop()
+
+
+def test_mirror(client):
+    client += ["alfred rdf:type Human", "cup1 isIn kitchen", "alfred likes icecream"]
+    with client.mirror(["* rdf:type *", "?obj isIn ?place"], refresh_interval = 0.2) as mirror:
+        assert mirror["?x rdf:type Human"] == ["alfred"]
+        assert "cup1 isIn kitchen" in mirror
+        assert mirror["?o isIn ?p", "?o rdf:type Human"] == []
+        # not covered by the mirror: forwarded
+        assert "alfred likes icecream" in mirror
+        assert mirror.stats()["forwarded_queries"] == 1
+
+        client += ["bob rdf:type Human"]
+        assert wait_for(lambda: sorted(mirror["?x rdf:type Human"]) == ["alfred", "bob"])
+        client -= ["alfred rdf:type Human"]
+        assert wait_for(lambda: mirror["?x rdf:type Human"] == ["bob"])
+        assert mirror.staleness() < 1
+        assert mirror.memory() > 0
+
+
+def test_concurrent_mirror_refreshes(client):
+    client += ["cup%d isIn kitchen" % i for i in range(10)]
+    with client.mirror(["?obj isIn ?place"], refresh_interval = 0) as mirror:
+        errors = []
+        def refresh():
+            try:
+                for i in range(20):
+                    mirror.refresh()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target = refresh) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors
+        assert len(mirror["?o isIn kitchen"]) == 10
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+""" Embedded knowledge base, against the stand-in MinimalKB. """
+
+import threading
+
+import pytest
+
+import kb
+
+from conftest import wait_for
+
+
+@pytest.mark.parametrize("direct", [False, True])
+def test_requests(minimalkb, direct):
+    with kb.KB(embedded = True, direct = direct) as k:
+        k += ["alfred rdf:type Human", "alfred likes icecream"]
+        assert k["?h rdf:type Human"] == ["alfred"]
+        assert "alfred likes *" in k
+        k -= ["alfred likes icecream"]
+        assert "alfred likes *" not in k
+
+        with pytest.raises(kb.KbError):
+            k.exist([1])
+        assert "alfred" in k
+
+        executed_by_caller = kb.EmbeddedKBClient.kb.threads == {threading.current_thread().name}
+        assert executed_by_caller == direct
+
+
+def test_direct_and_queued_clients(minimalkb):
+    with kb.KB(embedded = True, direct = True) as direct:
+        with kb.KB(embedded = True) as queued:
+            errors = []
+            def worker(k, offset):
+                try:
+                    for i in range(offset, 40, 4):
+                        k += ["obj_%d isIn kitchen" % i]
+                        assert ("obj_%d isIn kitchen" % i) in k
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target = worker, args = (k, i)) \
+                       for i, k in enumerate([direct, queued, direct, queued])]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert not errors
+            assert len(direct["?o isIn kitchen"]) == 40
+            assert len(queued["?o isIn kitchen"]) == 40
+    assert kb.EmbeddedKBClient.kb is None
+
+
+@pytest.mark.parametrize("direct", [False, True])
+def test_events(minimalkb, direct):
+    with kb.KB(embedded = True, direct = direct) as k:
+        received = []
+        k.subscribe(["?o isIn kitchen"], received.append)
+        event_id = k.subscribe(["?o isOn table"])
+
+        k += ["cup isIn kitchen", "plate isOn table"]
+        assert wait_for(lambda: received == [["cup"]])
+        assert k.events.get(timeout = 2) == (event_id, ["plate"])
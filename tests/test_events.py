@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+""" Event subscriptions. """
+
+import kb
+
+from conftest import wait_for
+
+
+def test_callback(client):
+    received = []
+    client.subscribe(["?o isIn kitchen"], received.append)
+    client += ["cup isIn kitchen"]
+    assert wait_for(lambda: received == [["cup"]])
+
+
+def test_polled_events(client):
+    event_id = client.subscribe(["?o isIn kitchen"])
+    client += ["cup isIn kitchen"]
+    assert client.events.get(timeout = 2) == (event_id, ["cup"])
+
+
+def test_identical_subscriptions_share_a_server_event(server, client):
+    a, b = [], []
+    e1 = client.subscribe(["?o isIn kitchen", "?o rdf:type Cup"], a.append, var = "o")
+    e2 = client.subscribe(["?o  rdf:type Cup", "?o isIn kitchen"], b.append, var = "?o")
+    e3 = client.subscribe(["?o isIn kitchen", "?o rdf:type Cup"], var = "o")
+    e4 = client.subscribe(["?o isIn kitchen", "?o rdf:type Cup"], var = "o")
+    assert e1 == e2 == e3 == e4
+    assert len(server.kb.subscriptions) == 1
+
+    client += ["cup1 isIn kitchen", "cup1 rdf:type Cup"]
+    assert wait_for(lambda: a == b == [["cup1"]])
+    # the polled subscriptions get each event once
+    assert client.events.get(timeout = 2) == (e1, ["cup1"])
+    assert wait_for(lambda: client.events.empty())
+    assert client.events.empty()
+
+
+def test_one_shot_subscriptions_are_not_shared(server, client):
+    e1 = client.subscribe("?o isIn kitchen", trigger = "ON_TRUE_ONE_SHOT")
+    e2 = client.subscribe("?o isIn kitchen", trigger = "ON_TRUE_ONE_SHOT")
+    assert e1 != e2
+    assert len(server.kb.subscriptions) == 2
+
+
+def test_unsubscribe_is_reference_counted(client):
+    a, b = [], []
+    event_id = client.subscribe("?o isIn kitchen", a.append)
+    client.subscribe("?o isIn kitchen", b.append)
+
+    client.unsubscribe(event_id, a.append)
+    client += ["cup isIn kitchen"]
+    assert wait_for(lambda: b == [["cup"]])
+    assert a == []
+
+    client.unsubscribe(event_id, b.append)
+    assert client.stats()["subscriptions"]["subscribers"] == 0
+    try:
+        client.unsubscribe(event_id, b.append)
+    except kb.KbError:
+        pass
+    else:
+        assert False, "a cancelled subscription can not be cancelled again"
+
+
+def test_slow_callback_does_not_delay_other_subscriptions(server):
+    import threading
+    release = threading.Event()
+    fast = []
+    with kb.KB(port = server.port, callback_workers = 2) as k:
+        k.subscribe("?o isIn kitchen", lambda value: release.wait(5))
+        k.subscribe("?o isIn garden", fast.append)
+        k += ["cup isIn kitchen"]
+        k += ["rake isIn garden"]
+        assert wait_for(lambda: fast == [["rake"]])
+        release.set()
+
+
+def test_slow_callback_does_not_delay_polled_events(client):
+    import threading
+    release = threading.Event()
+    client.subscribe("?o isIn kitchen", lambda value: release.wait(5))
+    garden = client.subscribe("?o isIn garden")
+    client += ["cup isIn kitchen"]
+    client += ["rake isIn garden"]
+    try:
+        assert client.events.get(timeout = 1) == (garden, ["rake"])
+    finally:
+        release.set()
+
+
+def test_cancelled_polled_subscription_drops_its_events(client):
+    event_id = client.subscribe("?o isIn kitchen")
+    client.unsubscribe(event_id)
+    received = []
+    client.subscribe("?o isIn garden", received.append)
+    client += ["cup isIn kitchen", "rake isIn garden"]
+    assert wait_for(lambda: received == [["rake"]])
+    assert client.events.empty()
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+""" Requests and responses, through a real connection to the stand-in
+server.
+"""
+
+import threading
+import time
+
+import pytest
+
+import kb
+
+from conftest import wait_for
+
+
+def test_add_query_retract(client):
+    client += ["alfred rdf:type Human", "alfred likes icecream"]
+    assert client["?h rdf:type Human"] == ["alfred"]
+    assert "alfred likes icecream" in client
+    assert "alfred likes *" in client
+    assert "alfred" in client
+
+    client -= ["alfred likes icecream"]
+    assert "alfred likes *" not in client
+    assert client["?a likes ?b"] == []
+
+
+def test_multiple_patterns(client):
+    client += ["alfred desires jump", "bob desires oil", "jump rdf:type Action"]
+    assert client["?agent desires ?obj", "?obj rdf:type Action"] == [{"agent": "alfred", "obj": "jump"}]
+
+
+def test_server_error(client):
+    with pytest.raises(kb.KbError):
+        client.exist([1])
+    # the connection is still usable
+    client += ["a b c"]
+    assert "a b c" in client
+
+
+@pytest.mark.parametrize("options", [{}, {"binary": True}, {"compression": True}])
+def test_protocols(server, options):
+    server.kb.result_size = 5000
+    with kb.KB(port = server.port, **options) as k:
+        res = k["?agent desires ?action"]
+        assert len(res) == 5000
+        assert res[42] == {"agent": "agent_42", "action": "action_42"}
+        if options:
+            assert k.stats()["codec"] is not None
+
+
+def test_stats(client):
+    reports = []
+    client.enable_stats(hook = reports.append, interval = 0.05)
+    client += ["a b c"]
+    assert "a b c" in client
+    assert "x y z" not in client
+    with pytest.raises(kb.KbError):
+        client.exist([1])
+    received = []
+    client.subscribe(["?o isIn kitchen"], received.append)
+    client += ["cup isIn kitchen"]
+    assert wait_for(lambda: received == [["cup"]])
+
+    stats = client.stats()
+    exist = stats["methods"]["exist"]
+    assert (exist["calls"], exist["errors"]) == (3, 1)
+    assert exist["total"]["count"] == 3
+    assert 0 < exist["total"]["p50"] <= exist["total"]["max"]
+    assert exist["bytes_sent"] > 0 and exist["bytes_received"] > 0
+    assert stats["methods"]["update"]["calls"] == 2
+    assert stats["events"] == 1
+    assert stats["queues"] == {"internal_events": 0, "events": 0, "callbacks": 0}
+    assert stats["pending_requests"] == 0
+    assert wait_for(lambda: reports and "methods" in reports[-1])
+
+    # a new hook replaces the previous one
+    new_reports = []
+    client.enable_stats(hook = new_reports.append, interval = 0.05)
+    assert wait_for(lambda: new_reports)
+    count = len(reports)
+    time.sleep(0.2)
+    assert len(reports) == count
+
+
+def test_compression_stats(server):
+    server.kb.result_size = 5000
+    with kb.KB(port = server.port, compression = True) as k:
+        k.enable_stats()
+        assert len(k["?agent desires ?action"]) == 5000
+        stats = k.stats()
+        assert stats["compression_algorithm"] is not None
+        assert stats["compression"]["decompressed"] == 1
+        assert stats["compression"]["decompressed_bytes_saved"] > 0
+
+
+def test_binary_falls_back_to_text(text_server):
+    with kb.KB(port = text_server.port, binary = True) as k:
+        k += ["a b c"]
+        assert "a b c" in k
+        assert k.stats()["codec"] is None
+
+
+def test_concurrent_callers_get_their_own_answers(client):
+    client += ["obj_%d isIn kitchen" % i for i in range(0, 50, 2)]
+    errors = []
+
+    def worker(offset):
+        try:
+            for i in range(offset, 50, 5):
+                assert (("obj_%d isIn kitchen" % i) in client) == (i % 2 == 0)
+                assert client.about("obj_%d" % i) == ([["obj_%d" % i, "isIn", "kitchen"]] if i % 2 == 0 else [])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target = worker, args = (i,)) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+
+
+def test_submit_pipelines(client):
+    client += ["a b c"]
+    futures = [client.submit("exist", ["a b c" if i % 2 else "x y z"]) for i in range(100)]
+    assert [f.result() for f in futures] == [bool(i % 2) for i in range(100)]
+
+
+def test_iter_streams_large_results(server, client):
+    server.kb.result_size = 20000
+    rows = list(client.iter("?agent desires ?action", page_size = 100))
+    assert len(rows) == 20000
+    assert rows[-1] == {"agent": "agent_19999", "action": "action_19999"}
+
+
+def test_dropped_iteration_does_not_block_the_connection(server, client):
+    received = []
+    client.subscribe(["?o isIn room"], received.append)
+    server.kb.result_size = 20000
+    for row in client.iter("?agent desires ?action", page_size = 10):
+        break
+
+    with kb.KB(port = server.port) as other:
+        other += ["cup isIn room"]
+    assert wait_for(lambda: received == [["cup"]])
+
+
+def test_many_preserve_order(client):
+    client += ["alfred likes icecream", "alfred rdf:type Human"]
+    items = ["alfred likes *", "alfred", "nobody", "bob likes *", "alfred rdf:type Human"]
+    assert client.exist_many(items) == [item in client for item in items]
+    assert client.exist_many([["* likes icecream", "* rdf:type Human"]]) == [True]
+
+    assert client.find_many(["?x likes icecream", "?x rdf:type Robot"]) == [["alfred"], []]
+    assert client.lookup_many(["alfred", "nobody"]) == [[["alfred", "instance"]], []]
+
+
+def test_many_return_errors_in_place(server, client):
+    lookup = server.kb.lookup
+    def failing_lookup(connection, term, models = None):
+        if term == "broken":
+            raise ValueError("broken term")
+        return lookup(connection, term, models)
+    server.kb.lookup = failing_lookup
+
+    client += ["alfred rdf:type Human"]
+    res = client.lookup_many(["alfred", "broken", "nobody"])
+    assert res[0] == [["alfred", "instance"]]
+    assert isinstance(res[1], kb.KbError)
+    assert res[2] == []
+
+
+def test_result_sets(server):
+    with kb.KB(port = server.port, result_sets = True) as k:
+        k += ["alfred desires jump", "bob desires jump"]
+        res = k["?agent desires ?action"]
+        assert isinstance(res, kb.ResultSet)
+        assert sorted(res, key = lambda r: r["agent"]) == [{"agent": "alfred", "action": "jump"},
+                                                          {"agent": "bob", "action": "jump"}]
+        assert sorted(res.column("agent")) == ["alfred", "bob"]
+        assert set(res.rows()) == {("alfred", "jump"), ("bob", "jump")}
+        assert k["?x desires jump"] == k["?x desires jump"]
+        assert k["?x flies ?y"] == []
+
+        # no variable: one empty row per match, like a list
+        assert k["alfred desires jump"] == [{}]
+        assert not k["alfred desires nothing"]
+
+
+def test_cache_is_invalidated_by_writes(client):
+    client.enable_cache()
+    client += ["a b c"]
+    assert "a b c" in client
+    assert "a b c" in client
+    assert client.cache.hits == 1
+    client -= ["a b c"]
+    assert "a b c" not in client
+
+
+def test_cached_results_can_be_modified(client):
+    client.enable_cache()
+    client += ["alfred likes icecream"]
+    client["?a likes ?b"][0]["b"] = "broccoli"
+    client.lookup("alfred")[0].append("robot")
+    assert client["?a likes ?b"] == [{"a": "alfred", "b": "icecream"}]
+    assert client.lookup("alfred") == [["alfred", "instance"]]
+    assert client.cache.hits == 2
+
+
+def test_cache_ttl(server, client):
+    client.enable_cache(ttl = 0.2)
+    assert "a b c" not in client
+    with kb.KB(port = server.port) as other:
+        other += ["a b c"]
+    assert "a b c" not in client
+    assert wait_for(lambda: "a b c" in client)
+
+
+def test_cache_is_invalidated_by_watched_events(server, client):
+    client.enable_cache(watch = ["?o isIn kitchen"])
+    assert client["?o isIn kitchen"] == []
+    with kb.KB(port = server.port) as other:
+        other += ["cup isIn kitchen"]
+    assert wait_for(lambda: client["?o isIn kitchen"] == ["cup"])
+    assert client.cache.invalidations == 1
+
+
+def test_method_table_cache(server):
+    with kb.KB(port = server.port, cache_methods = True):
+        pass
+    with kb.KB(port = server.port, cache_methods = True) as k:
+        k += ["a b c"]
+        assert "a b c" in k
+
+
+def test_to_arrays(client):
+    numpy = pytest.importorskip("numpy")
+    client += ["a knows b", "b knows c", "a likes c"]
+    graph = client.to_arrays("* * *", page_size = 2)
+    assert len(graph) == 3
+    stmts = set((graph.terms[s], graph.terms[p], graph.terms[o])
+                for s, p, o in zip(graph.subjects, graph.predicates, graph.objects))
+    assert stmts == {("a", "knows", "b"), ("b", "knows", "c"), ("a", "likes", "c")}
+
+    client += ['a label "ice cream"', 'b label "ice"']
+    labels = client.to_arrays('* label "ice cream"')
+    assert [labels.terms[s] for s in labels.subjects] == ["a"]
+    assert [labels.terms[o] for o in labels.objects] == ['"ice cream"']
+
+    pytest.importorskip("scipy")
+    knows = graph.adjacency("knows")
+    assert knows.nnz == 2
+    assert knows[graph.ids["a"], graph.ids["b"]] == 1
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+""" Message framing and decoding, without any connection. """
+
+import json
+import zlib
+
+import pytest
+
+import kb
+
+
+def split_everywhere(data):
+    """ Yields ``data`` split in two pieces, at every possible position. """
+    for i in range(len(data) + 1):
+        yield data[:i], data[i:]
+
+
+def test_encode_decode_roundtrip():
+    raw = kb.encode("find", ["?x"], ["?x rdf:type Human"], models = ["A"])
+    assert raw.endswith(kb.MSG_SEPARATOR)
+    response = 'ok\n["alfred", "bob"]\n'
+    assert kb.decode(response) == ("ok", ["alfred", "bob"])
+
+
+def test_message_parser_any_split():
+    data = b'ok\n["a", 1, -2500.0]\n#end#event\nevt_1\n["cup"]\n#end#error\nKbError\nboom\n#end#'
+    for head, tail in split_everywhere(data):
+        parser = kb.MessageParser()
+        messages = list(parser.feed(head)) + list(parser.feed(tail))
+        assert [m[0] for m in messages] == ["ok", "event", "error"]
+        assert messages[0][1] == ["a", 1, -2500.0]
+        assert messages[1][1] == ("evt_1", ["cup"])
+
+
+@pytest.mark.parametrize("values", [
+    [1, -2500.0, 3],
+    [1e3, 2.5e-3, True, False, None],
+    ["a", {"x": "y"}, [1, 2], 12],
+])
+def test_array_decoder_any_split(values):
+    text = json.dumps(values)
+    for head, tail in split_everywhere(text):
+        decoder = kb._ArrayDecoder()
+        elements = decoder.feed(head) + decoder.feed(tail) + decoder.close()
+        assert elements == values, (head, tail)
+
+
+def test_array_decoder_number_split_at_dot():
+    decoder = kb._ArrayDecoder()
+    assert decoder.feed('[1, -2500.') == [1]
+    assert decoder.feed('0, 3]') == [-2500.0, 3]
+    assert decoder.close() == []
+
+
+def test_array_decoder_truncated():
+    decoder = kb._ArrayDecoder()
+    decoder.feed('[1, 2')
+    with pytest.raises(kb.KbError):
+        decoder.close()
+
+
+def test_frame_parser_any_split():
+    dumps = lambda value: json.dumps(value).encode("utf-8")
+    big = ["row_%d" % i for i in range(500)]
+    compressed = zlib.compress(dumps(["ok", big]))
+    data = kb.encode_frame(dumps, ["ok", [1, 2]]) + \
+           kb.FRAME_HEADER.pack(len(compressed), kb.FRAME_COMPRESSED) + compressed + \
+           kb.encode_frame(dumps, ["event", ["evt_0", ["cup"]]])
+
+    for head, tail in split_everywhere(data[:40]):
+        parser = kb.FrameParser(json.loads, zlib.decompress)
+        messages = list(parser.feed(head)) + list(parser.feed(tail + data[40:]))
+        assert messages == [("ok", [1, 2]), ("ok", big), ("event", ("evt_0", ["cup"]))]
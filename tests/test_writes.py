@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+""" Batches, write-behind and bulk loading. """
+
+import pytest
+
+import kb
+
+from conftest import wait_for
+
+
+def test_batch(server, client):
+    with client.batch():
+        client += ["a b c", "d e f"]
+        client -= ["d e f"]
+        assert "a b c" not in client
+    assert "a b c" in client
+    assert "d e f" not in client
+
+
+def test_batch_dropped_on_exception(client):
+    with pytest.raises(RuntimeError):
+        with client.batch():
+            client += ["a b c"]
+            raise RuntimeError()
+    assert "a b c" not in client
+
+
+def test_write_behind_flushes_after_max_delay(server):
+    with kb.KB(port = server.port) as writer, kb.KB(port = server.port) as reader:
+        writer.enable_write_behind(max_statements = 1000, max_delay = 0.01)
+        writer += "a isIn b"
+        assert wait_for(lambda: "a isIn b" in reader, timeout = 0.5)
+        writer += "c isIn d"
+        assert wait_for(lambda: "c isIn d" in reader, timeout = 0.5)
+
+
+def test_write_behind_sync(client):
+    client.enable_write_behind(max_statements = 1000, max_delay = 10)
+    client += ["a b c"]
+    client.sync()
+    assert "a b c" in client
+    client.sync()
+
+
+def test_load(client, tmp_path):
+    source = tmp_path / "world.nt"
+    source.write_text("# a comment\n\n" + "".join("s_%d p o_%d .\n" % (i, i) for i in range(250)))
+    progress = []
+    res = client.load_statements(source, chunk_size = 100, progress = lambda loaded, rate: progress.append(loaded))
+    assert res["statements"] == 250
+    assert progress == [100, 200, 250]
+    assert "s_249 p o_249" in client
+
+
+def test_load_resumes_after_failure(client):
+    stmts = ["s_%d p o" % i for i in range(10)]
+    with pytest.raises(kb.KbLoadError) as e:
+        client.load_statements(stmts[:5] + [1] + stmts[5:], chunk_size = 5, max_in_flight = 1)
+    assert e.value.offset == 5
+
+
+def test_load_is_the_server_method(server):
+    methods, loaded = server.kb.methods, []
+    server.kb.methods = lambda connection: methods(connection) + ["load(path, models)"]
+    server.kb.load = lambda connection, path, models = None: loaded.append(path)
+    with kb.KB(port = server.port) as k:
+        k.load("onto.owl")
+    assert loaded == ["onto.owl"]